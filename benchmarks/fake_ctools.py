@@ -0,0 +1,92 @@
+"""
+Stands in for the CTOOLS_HOURLY and CTOOLS_ANNUAL executables, so that the backend can be benchmarked without
+the Fortran model.  It is called the way the backend calls the real ones, after the mode it stands in for:
+
+    python benchmarks/fake_ctools.py HOURLY|ANNUAL SOURCE_TYPE DIRECTORY/
+
+and writes results_CTOOLS_<mode>_<source type>_Output.csv to the directory, with a row per receptor in
+receptors.csv.  Each receptor's value sums every source's emissions over a power of its distance, so the
+output is smooth, peaks by the sources, and costs time in proportion to sources times receptors the way a
+model run does.  FAKE_CTOOLS_SECONDS adds that many seconds to every run.  install() writes executables
+named like the real ones that run this script.
+"""
+import os
+import stat
+import sys
+import time
+
+import numpy
+
+# The source file each source type is read from, and the columns holding a source's position and emissions
+source_files = {
+    "AREA": ("area.csv", "x", "y", "nox"),
+    "POINT": ("points.csv", "x", "y", "nox"),
+    "RAIL": ("railways.csv", "fromx", "fromy", "nox"),
+    "ROAD": ("roads.csv", "from_x", "from_y", "aadt"),
+    "SIT": ("sit.csv", "startx", "starty", "nox")
+}
+
+road_multipliers = ("gas_car_multiplier", "gas_truck_multiplier", "diesel_car_multiplier", "diesel_truck_multiplier")
+
+# Cells in each block of the source by receptor distance matrix
+_block_size = 1 << 20
+
+
+def install(directory, python=None):
+    """
+    Writes CTOOLS_HOURLY.ifort.x and CTOOLS_ANNUAL.ifort.x to directory, each running this script with python
+    (by default the running interpreter, which needs NumPy).
+    """
+    script = os.path.splitext(os.path.realpath(__file__))[0] + ".py"
+    for mode in ("HOURLY", "ANNUAL"):
+        program = os.path.join(directory, "CTOOLS_%s.ifort.x" % mode)
+        with open(program, "w") as f:
+            f.write('#!/bin/sh\nexec "%s" "%s" %s "$@"\n' % (python or sys.executable, script, mode))
+        os.chmod(program, os.stat(program).st_mode | stat.S_IXUSR | stat.S_IXGRP | stat.S_IXOTH)
+
+
+def read_csv(file_name):
+    """
+    Reads a backend written CSV file into a dictionary of columns.
+    """
+    with open(file_name) as f:
+        headers = [h.strip() for h in f.readline().split(",")]
+        rows = [line.split(",") for line in f if line.strip()]
+    columns = {}
+    for (i, header) in enumerate(headers):
+        try:
+            columns[header] = numpy.array([float(row[i]) for row in rows])
+        except ValueError:
+            # Name columns
+            columns[header] = None
+    return columns
+
+
+def concentrations(source_x, source_y, emissions, receptor_x, receptor_y):
+    values = numpy.zeros(len(receptor_x))
+    step = max(_block_size // max(len(receptor_x), 1), 1)
+    for start in range(0, len(source_x), step):
+        dx = receptor_x[numpy.newaxis, :] - source_x[start:start + step, numpy.newaxis]
+        dy = receptor_y[numpy.newaxis, :] - source_y[start:start + step, numpy.newaxis]
+        values += (emissions[start:start + step, numpy.newaxis] / (1 + numpy.hypot(dx, dy) / 50.0) ** 1.5).sum(axis=0)
+    return values
+
+
+def main():
+    (mode, source_type, directory) = sys.argv[1:4]
+    (source_file, x_field, y_field, emission_field) = source_files[source_type]
+    sources = read_csv(os.path.join(directory, source_file))
+    receptors = read_csv(os.path.join(directory, "receptors.csv"))
+    emissions = sources[emission_field] * 1e-3
+    if source_type == "ROAD":
+        emissions = emissions * sum(sources[m] for m in road_multipliers) / len(road_multipliers)
+    values = concentrations(sources[x_field], sources[y_field], emissions, receptors["x"], receptors["y"])
+    time.sleep(float(os.environ.get("FAKE_CTOOLS_SECONDS", 0)))
+    output_file = os.path.join(directory, "results_CTOOLS_%s_%s_Output.csv" % (mode, source_type))
+    with open(output_file, "w") as f:
+        f.write("Receptor,X,Y,Conc,Cancer_Risk,Non_Cancer_Risk\n")
+        for (id_, x, y, value) in zip(receptors["id"], receptors["x"], receptors["y"], values):
+            f.write("%d, %.4f, %.4f, %.6E, %.6E, %.6E\n" % (id_, x, y, value, value * 1e-3, value * 1e-2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,75 @@
+"""
+Measures how long the ctools_backend entry points take to import, each in a fresh interpreter, and which
+heavy dependencies each one pulls in.  Results can be saved as JSON and compared against a saved baseline:
+
+    python benchmarks/import_time.py --output import_time.json
+    python benchmarks/import_time.py --baseline import_time.json
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+repository_directory = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+
+entry_points = ["ctools_backend.tasks", "ctools_backend.worker", "ctools_backend.models", "ctools_backend.wrappers",
+                "ctools_backend.raster"]
+heavy_modules = ["matplotlib", "scipy", "tablib", "shapely", "kombu"]
+
+_probe = """
+import json, sys, time
+start = time.time()
+import %s
+elapsed = time.time() - start
+print(json.dumps({"seconds": elapsed, "modules": [m for m in %r if m in sys.modules],
+                  "engine_created": getattr(sys.modules.get("ctools_backend.models"), "_engine", None) is not None}))
+"""
+
+
+def measure(module, repeat):
+    runs = []
+    for _ in range(repeat):
+        output = subprocess.check_output([sys.executable, "-c", _probe % (module, heavy_modules)],
+                                         cwd=repository_directory)
+        runs.append(json.loads(output.decode("utf-8").strip().splitlines()[-1]))
+    seconds = sorted(run["seconds"] for run in runs)
+    return {"median_seconds": seconds[len(seconds) // 2], "min_seconds": seconds[0],
+            "modules": runs[-1]["modules"], "engine_created": runs[-1]["engine_created"]}
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-n", "--repeat", type=int, default=5, help="Imports to time per entry point")
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="Compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction by which an entry point may be slower than the baseline")
+    parser.add_argument("modules", nargs="*", default=entry_points)
+    args = parser.parse_args()
+    results = {module: measure(module, args.repeat) for module in args.modules}
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    for module in args.modules:
+        result = results[module]
+        line = "%-28s %7.3fs  %s" % (module, result["median_seconds"], ", ".join(result["modules"]) or "-")
+        if result["engine_created"]:
+            line += "  (creates engine)"
+        if module in baseline:
+            before = baseline[module]["median_seconds"]
+            line += "  baseline %.3fs (%+.0f%%)" % (before, (result["median_seconds"] / before - 1) * 100)
+            if result["median_seconds"] > before * (1 + args.tolerance):
+                regressions.append(module)
+        print(line)
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("Slower than the baseline: %s" % ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
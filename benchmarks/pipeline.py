@@ -0,0 +1,165 @@
+"""
+Times each stage of a scenario run on a synthetic scenario (see synthetic.py), from loading its sources through
+rendering and archiving the results, with fake_ctools.py standing in for the model so that it runs offline.
+The stages are the phases metrics.RunMetrics records, plus "sources", building the source tables.  Results can
+be saved as JSON and compared against a saved baseline, and --scale times a range of sizes of one kind of source
+to give scaling curves:
+
+    python benchmarks/pipeline.py --roads 5000 --output pipeline.json
+    python benchmarks/pipeline.py --roads 5000 --baseline pipeline.json
+    python benchmarks/pipeline.py --scale roads 1000 4000 16000 --output scaling.json
+"""
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+import numpy
+
+import fake_ctools
+# Imported before ctools_backend, which it puts on the path
+import synthetic
+from ctools_backend import archive, metrics, settings, wrappers
+
+source_options = ["roads", "area_sources", "point_sources", "railways", "ships_in_transit"]
+
+
+def _install_fake_ctools(directory):
+    fake_ctools.install(directory)
+    settings.ctools_dir = directory
+    wrappers.CTools._program = os.path.join(directory, "CTOOLS_HOURLY.ifort.x")
+    wrappers.CTools._annual_program = os.path.join(directory, "CTOOLS_ANNUAL.ifort.x")
+
+
+def run_once(scenario, directory, output_mode="image"):
+    """
+    Runs a scenario through the whole pipeline in directory, returning its metrics.
+    """
+    from ctools_backend import raster
+    scenario_run = synthetic.SyntheticScenarioRun(scenario, os.path.join(directory, "run"))
+    os.makedirs(scenario_run.output_directory)
+    run_metrics = metrics.RunMetrics("benchmark")
+    with metrics.collect(run_metrics):
+        with metrics.phase("sources"):
+            ctools = wrappers.CTools(scenario=scenario, scenario_run=scenario_run)
+        concentrations = ctools.calculate_concentrations()
+        concentrations[:, 2] = numpy.log10(concentrations[:, 2])
+        raster.RasterGenerator(scenario_run).create_pollution_raster(concentrations, output_mode)
+        with metrics.phase("archiving"):
+            archive.write_archive(archive.directory_members(scenario_run.output_directory),
+                                  os.path.join(directory, "results" + archive.extension(settings.archive_compression)),
+                                  settings.archive_compression)
+    result = run_metrics.to_dict()
+    result["receptors"] = len(ctools.receptors)
+    return result
+
+
+def measure(sizes, repeat, output_mode="image"):
+    """
+    Runs a synthetic scenario with the given number of each kind of source repeat times, returning the median
+    and minimum wall time of each stage and of the whole run, along with the binaries' CPU time and peak memory.
+    """
+    scenario = synthetic.generate_scenario(**sizes)
+    runs = []
+    for _ in range(repeat):
+        directory = tempfile.mkdtemp(prefix="ctools_benchmark_")
+        try:
+            runs.append(run_once(scenario, directory, output_mode))
+        finally:
+            shutil.rmtree(directory)
+    stages = {}
+    for name in set(name for run in runs for name in run["phases"]):
+        seconds = sorted(run["phases"].get(name, {}).get("wall_seconds", 0.0) for run in runs)
+        stages[name] = {"median_seconds": seconds[len(seconds) // 2], "min_seconds": seconds[0]}
+    seconds = sorted(run["wall_seconds"] for run in runs)
+    stages["total"] = {"median_seconds": seconds[len(seconds) // 2], "min_seconds": seconds[0]}
+    binaries = runs[-1]["binaries"]
+    return {"sizes": sizes, "receptors": runs[-1]["receptors"], "stages": stages,
+            "binary_cpu_seconds": sum(b["cpu_seconds"] for b in binaries.values()),
+            "binary_peak_rss_bytes": max([b["peak_rss_bytes"] for b in binaries.values()] or [0])}
+
+
+def _print_stages(label, result, baseline, tolerance, regressions):
+    print("%s: %d receptors, binaries %.2fs CPU, %.1f MB peak" % (
+        label, result["receptors"], result["binary_cpu_seconds"], result["binary_peak_rss_bytes"] / 1e6))
+    for (name, stage) in sorted(result["stages"].items(), key=lambda item: -item[1]["median_seconds"]):
+        line = "  %-14s %8.3fs" % (name, stage["median_seconds"])
+        before = (baseline or {}).get("stages", {}).get(name)
+        if before and before["median_seconds"] > 0:
+            line += "  baseline %.3fs (%+.0f%%)" % (before["median_seconds"],
+                                                    (stage["median_seconds"] / before["median_seconds"] - 1) * 100)
+            if stage["median_seconds"] > before["median_seconds"] * (1 + tolerance):
+                regressions.append("%s %s" % (label, name))
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    for option in source_options:
+        parser.add_argument("--" + option.replace("_", "-"), type=int, default=1000 if option == "roads" else 10,
+                            help="How many %s the scenario has" % option.replace("_", " "))
+    parser.add_argument("--scale", nargs="+", metavar=("SOURCES", "SIZE"),
+                        help="Time each of these sizes of one kind of source, e.g. --scale roads 1000 4000 16000")
+    parser.add_argument("-n", "--repeat", type=int, default=3, help="Runs to time per scenario")
+    parser.add_argument("--output-mode", choices=["image", "tiles"], default="image", help="How rasters are written")
+    parser.add_argument("--model-seconds", type=float, default=0,
+                        help="Seconds the stand-in model takes on top of its own work, per run")
+    parser.add_argument("--cache", action="store_true", help="Keep the result cache on, in a temporary directory")
+    parser.add_argument("-o", "--output", help="Save the results to this JSON file")
+    parser.add_argument("-b", "--baseline", help="Compare against results saved with --output")
+    parser.add_argument("--tolerance", type=float, default=0.25,
+                        help="Fraction by which a stage may be slower than the baseline")
+    args = parser.parse_args()
+    if args.scale and (args.scale[0] not in source_options or len(args.scale) < 2):
+        parser.error("--scale takes one of %s and at least one size" % ", ".join(source_options))
+    sizes = dict((option, getattr(args, option)) for option in source_options)
+    work_directory = tempfile.mkdtemp(prefix="ctools_benchmark_")
+    try:
+        _install_fake_ctools(work_directory)
+        os.environ["FAKE_CTOOLS_SECONDS"] = str(args.model_seconds)
+        settings.status_notifications = False
+        settings.metrics_textfile = None
+        settings.result_cache_directory = os.path.join(work_directory, "result_cache") if args.cache else None
+        results = {"run": measure(sizes, args.repeat, args.output_mode)}
+        if args.scale:
+            option = args.scale[0]
+            results["scaling"] = {"sources": option, "runs": []}
+            for size in args.scale[1:]:
+                scaled_sizes = dict(sizes, **{option: int(size)})
+                results["scaling"]["runs"].append(measure(scaled_sizes, args.repeat, args.output_mode))
+    finally:
+        shutil.rmtree(work_directory)
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = []
+    _print_stages("run", results["run"], baseline.get("run"), args.tolerance, regressions)
+    if args.scale:
+        baseline_runs = dict((run["sizes"][option], run) for run in baseline.get("scaling", {}).get("runs", [])
+                             if baseline["scaling"]["sources"] == option)
+        for run in results["scaling"]["runs"]:
+            size = run["sizes"][option]
+            _print_stages("%s=%d" % (option, size), run, baseline_runs.get(size), args.tolerance, regressions)
+        # How each stage grows with the number of sources, as the exponent of a power law fitted to the runs
+        runs = results["scaling"]["runs"]
+        if len(runs) > 1:
+            print("scaling with %s:" % option)
+            for name in sorted(runs[0]["stages"]):
+                seconds = [run["stages"].get(name, {}).get("median_seconds", 0) for run in runs]
+                if min(seconds) > 0:
+                    counts = [run["sizes"][option] for run in runs]
+                    exponent = numpy.polyfit(numpy.log(counts), numpy.log(seconds), 1)[0]
+                    results["scaling"].setdefault("exponents", {})[name] = exponent
+                    print("  %-14s %s  ~n^%.2f" % (name, " ".join("%8.3fs" % s for s in seconds), exponent))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    if regressions:
+        print("Slower than the baseline: %s" % ", ".join(regressions))
+        sys.exit(1)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,144 @@
+"""
+Synthetic scenarios of any size for benchmarking, laid out the way scenarios are stored, with sources scattered
+over a bounding box.  Nothing here touches the database: scenarios are left transient, and SyntheticScenarioRun
+stands in for a scenario run row.
+"""
+import os
+import sys
+
+import numpy
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+from ctools_backend import geo, models, superposition
+
+# Central Atlanta, in (min_lng, min_lat, max_lng, max_lat)
+default_bounds = (-84.50, 33.70, -84.30, 33.85)
+
+# Fields set from a source's first or last vertex, projected, as (vertex, 0 for x or 1 for y)
+_endpoint_fields = {
+    "from_x": (0, 0), "from_y": (0, 1), "to_x": (-1, 0), "to_y": (-1, 1),
+    "fromx": (0, 0), "fromy": (0, 1), "tox": (-1, 0), "toy": (-1, 1),
+    "startx": (0, 0), "starty": (0, 1), "endx": (-1, 0), "endy": (-1, 1),
+    "x": (0, 0), "y": (0, 1)
+}
+
+# The ranges other numeric fields are drawn from; emissions and anything else not listed are drawn from the default
+_ranges = {
+    "aadt": (500, 150000), "mph": (25, 70), "fclass_rev": (1, 19), "stfips": (13, 13), "ctfips": (121, 121),
+    "stkht": (5.0, 100.0), "stkdm": (0.5, 5.0), "stktmp": (300.0, 700.0), "stkvel": (1.0, 30.0),
+    "stack_height": (10.0, 40.0), "stack_diameter": (0.5, 3.0), "stack_velocity": (5.0, 20.0),
+    "stack_temperature": (400.0, 700.0)
+}
+_default_range = (0.01, 10.0)
+
+_integer_fields = ("gid", "id", "sf_id", "aadt", "mph", "fclass_rev", "stfips", "ctfips")
+_name_fields = ("sign1", "facility", "pltname", "rrowner1")
+
+
+def _lines(random, count, bounds, max_vertices):
+    # Random walks of 2 to max_vertices vertices, a few hundred metres a step
+    (min_lng, min_lat, max_lng, max_lat) = bounds
+    geometries = []
+    starts = zip(random.uniform(min_lng, max_lng, count), random.uniform(min_lat, max_lat, count))
+    for ((lng, lat), vertex_count) in zip(starts, random.randint(2, max_vertices + 1, count)):
+        steps = random.normal(0, 0.003, (vertex_count - 1, 2))
+        vertices = numpy.vstack(([lng, lat], [lng, lat] + numpy.cumsum(steps, axis=0)))
+        geometries.append(vertices.tolist())
+    return geometries
+
+
+def _polygons(random, count, bounds):
+    # Closed rectangles a few hundred metres to a kilometre across
+    (min_lng, min_lat, max_lng, max_lat) = bounds
+    geometries = []
+    corners = zip(random.uniform(min_lng, max_lng, count), random.uniform(min_lat, max_lat, count))
+    for ((west, south), width, height) in zip(corners, random.uniform(0.002, 0.01, count),
+                                              random.uniform(0.002, 0.01, count)):
+        (east, north) = (west + width, south + height)
+        geometries.append([[west, south], [east, south], [east, north], [west, north], [west, south]])
+    return geometries
+
+
+def generate_sources(type_, count, bounds=default_bounds, seed=0, max_vertices=3):
+    """
+    Returns count random sources of a type such as models.Road, as rows laid out like type_.fields.  Lines
+    have up to max_vertices vertices.
+    """
+    random = numpy.random.RandomState(seed)
+    if type_ is models.PointSource:
+        geometries = numpy.column_stack((random.uniform(bounds[0], bounds[2], count),
+                                         random.uniform(bounds[1], bounds[3], count))).tolist()
+        endpoints = [[g, g] for g in geometries]
+    else:
+        if type_ is models.AreaSource:
+            geometries = _polygons(random, count, bounds)
+        else:
+            geometries = _lines(random, count, bounds, max_vertices)
+        endpoints = [[g[0], g[-1]] for g in geometries]
+    endpoints = numpy.array(endpoints, dtype=numpy.float64).reshape(-1, 2, 2)
+    (xs, ys) = geo.mercator_to_lcc_array(endpoints[:, :, 0].ravel(), endpoints[:, :, 1].ravel())
+    projected = numpy.dstack((xs.reshape(-1, 2), ys.reshape(-1, 2)))
+    columns = []
+    for field in type_.fields:
+        if field == "geom":
+            column = geometries
+        elif field in _endpoint_fields:
+            (vertex, axis) = _endpoint_fields[field]
+            column = projected[:, vertex, axis].tolist()
+        elif field in _name_fields:
+            column = ["%s %d" % (type_.__name__, i) for i in range(count)]
+        elif field == "in_port":
+            column = (random.uniform(size=count) < 0.5).tolist()
+        elif field in superposition.multiplier_fields:
+            column = [1.0] * count
+        elif field in ("gid", "id", "sf_id"):
+            column = range(1, count + 1)
+        else:
+            (low, high) = _ranges.get(field, _default_range)
+            if field in _integer_fields:
+                column = random.randint(low, high + 1, count).tolist()
+            else:
+                column = random.uniform(low, high, count).tolist()
+        columns.append(column)
+    return [list(row) for row in zip(*columns)]
+
+
+def generate_scenario(roads=1000, area_sources=10, point_sources=10, railways=10, ships_in_transit=10,
+                      bounds=default_bounds, seed=0, name="Synthetic"):
+    """
+    Returns a transient models.Scenario with the given number of each kind of source, including every kind
+    there is at least one of.  The same seed always gives the same scenario.
+    """
+    counts = {"roads": roads, "area_sources": area_sources, "point_sources": point_sources, "railways": railways,
+              "ships_in_transit": ships_in_transit}
+    sources = {}
+    for (i, (attribute, include, type_)) in enumerate(models.Scenario.source_lists):
+        sources[attribute] = generate_sources(type_, counts[attribute], bounds, seed + i)
+        sources[include] = counts[attribute] > 0
+    scenario = models.Scenario(scenario_id=0, name=name, hour=1, season=1, day=1, met_conditions=1, zoom=12, **sources)
+    scenario.compute_bounds()
+    return scenario
+
+
+class SyntheticScenarioRun(object):
+    """
+    Stands in for a models.ScenarioRun of a scenario, writing to output_directory, without a database row.  It
+    is never terminated.
+    """
+    __tablename__ = models.ScenarioRun.__tablename__
+
+    def __init__(self, scenario, output_directory, pollutant="1", model_type=1):
+        self.scenario = scenario
+        self.scenario_run_id = 0
+        self.status = "running"
+        self.output_directory = output_directory
+        self.pollutant = pollutant
+        self.model_type = model_type
+        self.model_min_value = None
+        self.model_max_value = None
+        (self.min_lng, self.min_lat, self.max_lng, self.max_lat) = scenario.bounds
+
+    @classmethod
+    def get_status(cls, scenario_run_id):
+        return "running"
@@ -0,0 +1,172 @@
+import Queue
+import gzip
+import os
+import subprocess
+import sys
+import tarfile
+import threading
+
+import settings
+
+# Compressors run as separate processes, for multi-threaded compression
+_external_compressors = {
+    "pigz": ["pigz", "-c"],
+    "zstd": ["zstd", "-T0", "-q", "-c"]
+}
+
+_extensions = {None: ".tar", "gzip": ".tar.gz", "pigz": ".tar.gz", "zstd": ".tar.zst"}
+
+_chunk_size = 1 << 16
+
+
+def extension(compression=None):
+    """
+    Returns the file extension for archives written with a compression (see write_archive).
+    """
+    return _extensions[compression]
+
+
+def directory_members(directory, arcname="."):
+    """
+    Lists a directory's files as archive members under arcname, the way "tar -C directory ." would.
+    """
+    return [(directory, arcname)]
+
+
+def _tar_into(members, fileobj):
+    with tarfile.open(fileobj=fileobj, mode="w|") as tar:
+        for (file_name, arcname) in members:
+            tar.add(file_name, arcname=arcname)
+
+
+def _close_quietly(f):
+    try:
+        f.close()
+    except (IOError, OSError):
+        pass
+
+
+def _write(members, compression, sink):
+    if compression in _external_compressors:
+        process = subprocess.Popen(_external_compressors[compression], stdin=subprocess.PIPE,
+                                   stdout=subprocess.PIPE)
+        errors = []
+
+        def feed():
+            try:
+                _tar_into(members, process.stdin)
+            except Exception:
+                errors.append(sys.exc_info())
+            finally:
+                _close_quietly(process.stdin)
+
+        feeder = threading.Thread(target=feed)
+        feeder.daemon = True
+        feeder.start()
+        try:
+            for chunk in iter(lambda: process.stdout.read(_chunk_size), b""):
+                sink.write(chunk)
+        finally:
+            _close_quietly(process.stdout)
+            feeder.join()
+            process.wait()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        if process.returncode:
+            raise IOError("%s exited with status %d" % (compression, process.returncode))
+    elif compression == "gzip":
+        compressed = gzip.GzipFile(filename="", mode="wb", fileobj=sink, compresslevel=settings.archive_gzip_level)
+        _tar_into(members, compressed)
+        compressed.close()
+    elif compression is None:
+        _tar_into(members, sink)
+    else:
+        raise ValueError("Unknown compression %r" % compression)
+
+
+def write_archive(members, file_name, compression=None):
+    """
+    Writes a tarball of the given (file or directory name, name in the archive) members straight from where
+    they are, without staging copies.  compression is None, "gzip", or "pigz" or "zstd" to compress on
+    several cores with those programs.
+    """
+    temporary_file = "%s.%d.%d.tmp" % (file_name, os.getpid(), threading.current_thread().ident)
+    try:
+        with open(temporary_file, "wb", 1 << 20) as f:
+            _write(members, compression, f)
+        os.rename(temporary_file, file_name)
+    except BaseException:
+        if os.path.exists(temporary_file):
+            os.remove(temporary_file)
+        raise
+
+
+class _Cancelled(Exception):
+    pass
+
+
+class _QueueWriter(object):
+    # Hands written data to the consuming thread, blocking while it is behind
+    def __init__(self, queue, cancelled):
+        self._queue = queue
+        self._cancelled = cancelled
+
+    def write(self, data):
+        while True:
+            if self._cancelled.is_set():
+                raise _Cancelled()
+            try:
+                self._queue.put(data, timeout=1)
+                return
+            except Queue.Full:
+                pass
+
+
+def stream_archive(members, compression=None, file_name=None):
+    """
+    Yields the compressed bytes of an archive (see write_archive) as they are produced, so that it can be
+    sent to a client before it is complete.  The archive is also saved to file_name when one is given.
+    Stopping early abandons the archive.
+    """
+    chunks = Queue.Queue(maxsize=64)
+    cancelled = threading.Event()
+    done = object()
+    errors = []
+
+    def produce():
+        try:
+            _write(members, compression, _QueueWriter(chunks, cancelled))
+        except _Cancelled:
+            return
+        except Exception:
+            errors.append(sys.exc_info())
+        try:
+            _QueueWriter(chunks, cancelled).write(done)
+        except _Cancelled:
+            pass
+
+    producer = threading.Thread(target=produce)
+    producer.daemon = True
+    producer.start()
+    temporary_file = file_name and "%s.%d.%d.tmp" % (file_name, os.getpid(), threading.current_thread().ident)
+    output = temporary_file and open(temporary_file, "wb", 1 << 20)
+    completed = False
+    try:
+        while True:
+            chunk = chunks.get()
+            if chunk is done:
+                break
+            if output:
+                output.write(chunk)
+            yield chunk
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+        completed = True
+    finally:
+        cancelled.set()
+        if output:
+            output.close()
+            if completed:
+                os.rename(temporary_file, file_name)
+            else:
+                os.remove(temporary_file)
@@ -1,8 +1,18 @@
+import struct
+
+import numpy
 import pyproj
-from geoalchemy2.shape import to_shape
 
+# A single projection object is shared by every transform in the process
 _lambert = pyproj.Proj("+proj=lcc +lat_1=33 +lat_2=45 +lat_0=40 +lon_0=-97 +x_0=0 +y_0=0 +ellps=GRS80 "
                        "+datum=NAD83 +units=m +no_defs")
+_uint32 = struct.Struct("<I")
+
+
+def to_shape(element):
+    # Shapely is only needed once geometries are read from the database, so it is not imported until then
+    from geoalchemy2.shape import to_shape as geometry_to_shape
+    return geometry_to_shape(element)
 
 
 def mercator_to_lcc(longitude, latitude):
@@ -13,6 +23,79 @@ def lcc_to_mercator(x, y):
     return _lambert(x, y, inverse=True)
 
 
+def _as_coordinate_buffer(values):
+    # Contiguous float64 arrays are handed to pyproj as they are; anything else is converted once here
+    if isinstance(values, numpy.ndarray) and values.dtype == numpy.float64 and values.flags.c_contiguous:
+        return values
+    return numpy.ascontiguousarray(values, dtype=numpy.float64)
+
+
+def mercator_to_lcc_array(longitudes, latitudes):
+    """
+    Projects arrays of longitudes and latitudes to Lambert conformal conic x and y arrays in one call.
+    """
+    return _lambert(_as_coordinate_buffer(longitudes), _as_coordinate_buffer(latitudes))
+
+
+def lcc_to_mercator_array(xs, ys):
+    """
+    Projects arrays of Lambert conformal conic x and y values back to longitude and latitude arrays.
+    """
+    return _lambert(_as_coordinate_buffer(xs), _as_coordinate_buffer(ys), inverse=True)
+
+
+_wkb_point = 1
+_wkb_line_string = 2
+_wkb_polygon = 3
+_wkb_multi_types = (4, 5, 6)
+
+
+def wkb_to_coordinates(geometries):
+    """
+    Decodes little endian (NDR) 2D WKB geometries into a single (n, 2) array of vertices and the offsets
+    where each geometry's vertices start, taking a point's coordinates, a line's vertices, or a polygon's
+    exterior ring, and the first part of multi geometries, as the scenario JSON stores them.  Only the
+    headers are read one geometry at a time; the vertices are gathered from every geometry at once.
+    """
+    buffer = b"".join(bytes(g) for g in geometries)
+    starts = []
+    counts = []
+    position = 0
+    for geometry in geometries:
+        end = position + len(geometry)
+        if buffer[position:position + 1] != b"\x01":
+            raise ValueError("Expected little endian (NDR) WKB")
+        part = position
+        (geometry_type,) = _uint32.unpack_from(buffer, part + 1)
+        if geometry_type in _wkb_multi_types:
+            # Skip the part count to the first part's own header
+            part += 9
+            (geometry_type,) = _uint32.unpack_from(buffer, part + 1)
+        if geometry_type == _wkb_point:
+            (start, count) = (part + 5, 1)
+        elif geometry_type == _wkb_line_string:
+            (count,) = _uint32.unpack_from(buffer, part + 5)
+            start = part + 9
+        elif geometry_type == _wkb_polygon:
+            (count,) = _uint32.unpack_from(buffer, part + 9)
+            start = part + 13
+        else:
+            raise ValueError("Unsupported WKB geometry type %d" % geometry_type)
+        if start + 16 * count > end:
+            raise ValueError("Expected 2D WKB")
+        starts.append(start)
+        counts.append(count)
+        position = end
+    counts = numpy.array(counts, dtype=numpy.int64)
+    offsets = numpy.concatenate(([0], numpy.cumsum(counts)))
+    # Byte positions of every coordinate, run by run, read in one gather
+    byte_counts = 16 * counts
+    byte_starts = numpy.repeat(numpy.array(starts, dtype=numpy.int64) - (numpy.cumsum(byte_counts) - byte_counts),
+                               byte_counts)
+    data = numpy.frombuffer(buffer, dtype=numpy.uint8)[byte_starts + numpy.arange(len(byte_starts))]
+    return data.view("<f8").astype(numpy.float64).reshape(-1, 2), offsets
+
+
 def point_list_to_multilinestring(point_list):
     return "MULTILINESTRING((" + ",".join("%s %s" % (lon, lat) for (lon, lat) in point_list) + "))"
 
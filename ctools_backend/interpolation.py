@@ -0,0 +1,74 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.spatial import Delaunay
+
+_cache_size = 8
+_cache = OrderedDict()
+_cache_lock = threading.Lock()
+
+
+def receptor_set_hash(lng, lat):
+    digest = hashlib.sha1()
+    digest.update(np.ascontiguousarray(lng, dtype=np.float64).tobytes())
+    digest.update(np.ascontiguousarray(lat, dtype=np.float64).tobytes())
+    return digest.hexdigest()
+
+
+class ReceptorInterpolator(object):
+    """
+    Piecewise linear interpolation of receptor values onto longitude/latitude grids.  The Delaunay
+    triangulation of the receptors is built once, and the barycentric weights of the most recent output
+    grid are kept so that interpolating new values onto the same grid is a single weighted sum.
+    """
+
+    def __init__(self, lng, lat):
+        self.key = receptor_set_hash(lng, lat)
+        self.triangulation = Delaunay(np.column_stack((lng, lat)))
+        self._grid_key = None
+        self._grid_weights = None
+        self._lock = threading.Lock()
+
+    @classmethod
+    def for_receptors(cls, lng, lat):
+        """
+        Returns the interpolator for a receptor set, reusing a cached triangulation when the same
+        receptors have been interpolated before.
+        """
+        key = receptor_set_hash(lng, lat)
+        with _cache_lock:
+            interpolator = _cache.pop(key, None)
+            if interpolator is None:
+                interpolator = cls(lng, lat)
+            _cache[key] = interpolator
+            while len(_cache) > _cache_size:
+                _cache.popitem(last=False)
+        return interpolator
+
+    def _weights(self, grid_lng, grid_lat):
+        grid_key = receptor_set_hash(grid_lng, grid_lat)
+        with self._lock:
+            if grid_key != self._grid_key:
+                points = np.column_stack((np.ravel(grid_lng), np.ravel(grid_lat)))
+                simplices = self.triangulation.find_simplex(points)
+                outside = simplices < 0
+                simplices[outside] = 0
+                transform = self.triangulation.transform[simplices]
+                barycentric = np.einsum("ijk,ik->ij", transform[:, :2, :], points - transform[:, 2, :])
+                weights = np.column_stack((barycentric, 1 - barycentric.sum(axis=1)))
+                vertices = self.triangulation.simplices[simplices]
+                self._grid_weights = (vertices, weights, outside)
+                self._grid_key = grid_key
+            return self._grid_weights
+
+    def interpolate(self, values, grid_lng, grid_lat, fill_value=0):
+        """
+        Interpolates one value per receptor onto the points of the given grids, returning a flat array.
+        Grid points outside the convex hull of the receptors are set to fill_value.
+        """
+        (vertices, weights, outside) = self._weights(grid_lng, grid_lat)
+        results = np.einsum("ij,ij->i", np.asarray(values, dtype=np.float64)[vertices], weights)
+        results[outside] = fill_value
+        return results
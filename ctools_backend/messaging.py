@@ -2,17 +2,43 @@ __author__ = 'nathan'
 
 from kombu import Connection, Exchange, Queue
 
+import settings
+
 process_management_exchange = Exchange('process_management', 'direct')
 test_queue = Queue('test', exchange=process_management_exchange, durable=False)
 
+# Scenario run jobs, consumed by worker.Worker.  Both are durable so queued jobs survive a broker restart.
+job_exchange = Exchange('scenario_runs', 'direct', durable=True)
+job_queue = Queue('scenario_runs', exchange=job_exchange, routing_key='scenario_runs', durable=True)
+
+
+def connect(url=None):
+    return Connection(url or settings.broker_url)
+
+
+def publish_job(task, args=(), kwargs=None, connection=None):
+    """
+    Queues a call of one of the functions in tasks.py (ctools, ctools_comparison or ctools_ensemble) for a
+    worker to run.  Arguments must be JSON serializable.
+    """
+    body = {"task": task, "args": list(args), "kwargs": kwargs or {}}
+    if connection is None:
+        with connect() as connection:
+            return publish_job(task, args, kwargs, connection)
+    producer = connection.Producer(serializer="json")
+    producer.publish(body, exchange=job_exchange, routing_key=job_queue.routing_key, declare=[job_queue],
+                     delivery_mode=2)
+
+
 def process_message(body, message):
     print body
     message.ack()
 
-with Connection('amqp://localhost') as conn:
-    producer = conn.Producer()
-    producer.publish("testing!", exchange=process_management_exchange, routing_key='test', declare=[test_queue])
-    with conn.Consumer(test_queue, callbacks=[process_message]) as consumer:
-        while True:
-            conn.drain_events()
 
+if __name__ == "__main__":
+    with Connection('amqp://localhost') as conn:
+        producer = conn.Producer()
+        producer.publish("testing!", exchange=process_management_exchange, routing_key='test', declare=[test_queue])
+        with conn.Consumer(test_queue, callbacks=[process_message]) as consumer:
+            while True:
+                conn.drain_events()
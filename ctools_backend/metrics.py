@@ -0,0 +1,238 @@
+import fcntl
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+import settings
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+# The families written to the textfile, with their types and help text
+_families = [
+    ("ctools_run_duration_seconds", "histogram", "Wall time of whole runs"),
+    ("ctools_runs_total", "counter", "Runs finished, by how they finished"),
+    ("ctools_phase_duration_seconds", "histogram", "Wall time spent in each phase of a run, excluding nested phases"),
+    ("ctools_phase_cpu_seconds_total", "counter", "CPU time of the backend process in each phase of a run"),
+    ("ctools_binary_duration_seconds", "histogram", "Wall time of each CTOOLS binary run"),
+    ("ctools_binary_cpu_seconds_total", "counter", "CPU time of the CTOOLS binaries"),
+    ("ctools_binary_peak_rss_bytes", "gauge", "Peak resident memory of any CTOOLS binary in the latest run")
+]
+
+
+def _cpu_time():
+    (user, system) = os.times()[:2]
+    return user + system
+
+
+def process_peak_rss(pid):
+    """
+    Returns the most memory in bytes a running process has had resident since it started (or last exec'd),
+    or 0 when that cannot be read.
+    """
+    try:
+        with open("/proc/%d/status" % pid) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (IOError, OSError, ValueError):
+        pass
+    return 0
+
+
+class RunMetrics(object):
+    """
+    The wall and CPU time a run spends in each of its phases, and the wall time, CPU time and peak resident
+    memory of each binary it runs.  A phase's times leave out the phases nested inside it, so the phases add
+    up to the run.  CPU times are those of the whole process, so phases on threads running at the same time
+    each count the others' CPU time too.
+    """
+
+    def __init__(self, tool):
+        self.tool = tool
+        self.status = None
+        self.wall_seconds = None
+        self.cpu_seconds = None
+        self.phases = {}
+        self.binaries = {}
+        self._durations = []
+        self._lock = threading.Lock()
+        self._started = (time.time(), _cpu_time())
+
+    def record_phase(self, name, wall, cpu):
+        with self._lock:
+            entry = self.phases.setdefault(name, {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0})
+            entry["count"] += 1
+            entry["wall_seconds"] += wall
+            entry["cpu_seconds"] += cpu
+            self._durations.append(("phase", name, wall))
+
+    def record_binary(self, name, wall, cpu, peak_rss):
+        """
+        Records a binary that ran for wall seconds, using cpu seconds and at most peak_rss bytes of memory.
+        Safe to call from any thread.
+        """
+        with self._lock:
+            entry = self.binaries.setdefault(name, {"count": 0, "wall_seconds": 0.0, "cpu_seconds": 0.0,
+                                                    "peak_rss_bytes": 0})
+            entry["count"] += 1
+            entry["wall_seconds"] += wall
+            entry["cpu_seconds"] += cpu
+            entry["peak_rss_bytes"] = max(entry["peak_rss_bytes"], peak_rss)
+            self._durations.append(("binary", name, wall))
+
+    def finish(self, status):
+        self.status = status
+        self.wall_seconds = time.time() - self._started[0]
+        self.cpu_seconds = _cpu_time() - self._started[1]
+
+    def to_dict(self):
+        with self._lock:
+            return {
+                "tool": self.tool,
+                "status": self.status,
+                "wall_seconds": self.wall_seconds,
+                "cpu_seconds": self.cpu_seconds,
+                "phases": dict((name, dict(entry)) for (name, entry) in self.phases.items()),
+                "binaries": dict((name, dict(entry)) for (name, entry) in self.binaries.items())
+            }
+
+
+def current():
+    """
+    Returns the RunMetrics being collected on this thread, or None.
+    """
+    return getattr(_local, "metrics", None)
+
+
+@contextmanager
+def collect(run_metrics):
+    """
+    Collects the phases run on this thread into run_metrics, finishing it when the block exits and exporting
+    it to settings.metrics_textfile.
+    """
+    previous = (current(), getattr(_local, "frames", None))
+    (_local.metrics, _local.frames) = (run_metrics, [])
+    status = "failed"
+    try:
+        yield run_metrics
+        status = "completed"
+    finally:
+        (_local.metrics, _local.frames) = previous
+        run_metrics.finish(status)
+        try:
+            export(run_metrics)
+        except (IOError, OSError):
+            logger.exception("Could not export the run's metrics")
+
+
+@contextmanager
+def phase(name):
+    """
+    Times the block as a phase of the run being collected on this thread, if there is one.
+    """
+    run_metrics = current()
+    if run_metrics is None:
+        yield
+        return
+    # The time spent in phases nested inside this one, which is left out of its own
+    nested = [0.0, 0.0]
+    frames = _local.frames
+    frames.append(nested)
+    (wall, cpu) = (time.time(), _cpu_time())
+    try:
+        yield
+    finally:
+        (wall, cpu) = (time.time() - wall, _cpu_time() - cpu)
+        frames.pop()
+        if frames:
+            frames[-1][0] += wall
+            frames[-1][1] += cpu
+        run_metrics.record_phase(name, wall - nested[0], cpu - nested[1])
+
+
+def _labels(**labels):
+    return ",".join('%s="%s"' % (key, str(value).replace("\\", r"\\").replace("\n", r"\n").replace('"', r'\"'))
+                    for (key, value) in sorted(labels.items()))
+
+
+def _observe(state, family, labels, value):
+    buckets = settings.metrics_duration_buckets
+    series = state.setdefault(family, {})
+    counts = series.get(labels)
+    if counts is None or len(counts) != len(buckets) + 2:
+        # Bucket counts per bound, then the sum and count of the observations
+        counts = series[labels] = [0] * len(buckets) + [0.0, 0]
+    for (i, bound) in enumerate(buckets):
+        if value <= bound:
+            counts[i] += 1
+    counts[-2] += value
+    counts[-1] += 1
+
+
+def _add(state, family, labels, value):
+    series = state.setdefault(family, {})
+    series[labels] = series.get(labels, 0) + value
+
+
+def _render(state):
+    lines = []
+    for (family, type_, help_text) in _families:
+        series = state.get(family)
+        if not series:
+            continue
+        lines.append("# HELP %s %s" % (family, help_text))
+        lines.append("# TYPE %s %s" % (family, type_))
+        for labels in sorted(series):
+            if type_ != "histogram":
+                lines.append("%s{%s} %r" % (family, labels, float(series[labels])))
+                continue
+            counts = series[labels]
+            for (bound, count) in zip(settings.metrics_duration_buckets, counts):
+                lines.append('%s_bucket{%s,le="%r"} %d' % (family, labels, float(bound), count))
+            lines.append('%s_bucket{%s,le="+Inf"} %d' % (family, labels, counts[-1]))
+            lines.append("%s_sum{%s} %r" % (family, labels, float(counts[-2])))
+            lines.append("%s_count{%s} %d" % (family, labels, counts[-1]))
+    return "\n".join(lines) + "\n"
+
+
+def export(run_metrics, file_name=None):
+    """
+    Adds a finished run to the Prometheus textfile (by default settings.metrics_textfile, where the node
+    exporter's textfile collector can pick it up).  Every worker process adds to the same totals, which are
+    kept beside it in a .state file, locked while it is updated.
+    """
+    file_name = file_name or settings.metrics_textfile
+    if not file_name:
+        return
+    tool = run_metrics.tool
+    with open(file_name + ".state", "a+") as state_file:
+        fcntl.flock(state_file, fcntl.LOCK_EX)
+        state_file.seek(0)
+        try:
+            state = json.loads(state_file.read() or "{}")
+        except ValueError:
+            state = {}
+        _observe(state, "ctools_run_duration_seconds", _labels(tool=tool), run_metrics.wall_seconds)
+        _add(state, "ctools_runs_total", _labels(tool=tool, status=run_metrics.status), 1)
+        for (kind, name, wall) in run_metrics._durations:
+            _observe(state, "ctools_%s_duration_seconds" % kind, _labels(**{"tool": tool, kind: name}), wall)
+        for (name, entry) in run_metrics.phases.items():
+            _add(state, "ctools_phase_cpu_seconds_total", _labels(tool=tool, phase=name), entry["cpu_seconds"])
+        for (name, entry) in run_metrics.binaries.items():
+            labels = _labels(tool=tool, binary=name)
+            _add(state, "ctools_binary_cpu_seconds_total", labels, entry["cpu_seconds"])
+            state.setdefault("ctools_binary_peak_rss_bytes", {})[labels] = entry["peak_rss_bytes"]
+        state_file.seek(0)
+        state_file.truncate()
+        state_file.write(json.dumps(state))
+        state_file.flush()
+        # Written while the state is still locked, so that an older total never replaces a newer one
+        temporary_file = "%s.%d.tmp" % (file_name, os.getpid())
+        with open(temporary_file, "w") as f:
+            f.write(_render(state))
+        os.rename(temporary_file, file_name)
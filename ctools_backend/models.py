@@ -3,27 +3,41 @@ __author__ = 'nathan'
 import uuid
 import os
 import tempfile
-import shutil
-import subprocess
 from collections import namedtuple
 import glob
+import itertools
+import threading
 
+import numpy
 import sqlalchemy as sa
 from sqlalchemy import orm
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.dialects.postgresql import JSON
 from geoalchemy2 import Geometry
-from geoalchemy2.shape import to_shape
 
-from ctools_backend import geo
+from ctools_backend import archive, geo, metrics
 import settings
 
-engine = sa.create_engine(settings.connection_string)
-Base = declarative_base(metadata=sa.MetaData(bind=engine))
-Session = orm.scoped_session(orm.sessionmaker(bind=engine))
+_engine = None
+_engine_lock = threading.Lock()
+
+
+def get_engine():
+    """
+    Returns the process's engine, creating it on first use so that importing the models stays cheap.
+    """
+    global _engine
+    if _engine is None:
+        with _engine_lock:
+            if _engine is None:
+                _engine = sa.create_engine(settings.connection_string)
+    return _engine
+
+Base = declarative_base()
+Session = orm.scoped_session(lambda: orm.Session(bind=get_engine()))
 
 def point_wkt_to_array(point):
-    return list(v[0] for v in to_shape(point).xy)
+    return list(v[0] for v in geo.to_shape(point).xy)
 
 def null_data(d):
     if d is None:
@@ -57,6 +71,90 @@ class Receptor(object):
                 instance in instance_tuples]
 
 
+class ReceptorSet(object):
+    """
+    A column oriented collection of receptors.  Each column is a NumPy array, and the lat/lng (or x/y)
+    columns are projected in a single call rather than once per receptor.  Receptor ids are expected to
+    be increasing, which is how CTools assigns them.
+    """
+    fields = Receptor.fields
+    namedtuple_class = Receptor.namedtuple_class
+
+    def __init__(self, id_, x, y, lat=None, lng=None):
+        self.id = numpy.asarray(id_, dtype=numpy.int64)
+        self.x = numpy.asarray(x, dtype=numpy.float64)
+        self.y = numpy.asarray(y, dtype=numpy.float64)
+        if lat is None or lng is None:
+            (lng, lat) = geo.lcc_to_mercator_array(self.x, self.y)
+        self.lat = numpy.asarray(lat, dtype=numpy.float64)
+        self.lng = numpy.asarray(lng, dtype=numpy.float64)
+
+    @classmethod
+    def from_lat_lng(cls, id_, lat, lng):
+        lat = numpy.asarray(lat, dtype=numpy.float64)
+        lng = numpy.asarray(lng, dtype=numpy.float64)
+        (x, y) = geo.mercator_to_lcc_array(lng, lat)
+        return cls(id_, x, y, lat=lat, lng=lng)
+
+    @classmethod
+    def concatenate(cls, *receptor_sets):
+        return cls(numpy.concatenate([r.id for r in receptor_sets]),
+                   numpy.concatenate([r.x for r in receptor_sets]),
+                   numpy.concatenate([r.y for r in receptor_sets]),
+                   lat=numpy.concatenate([r.lat for r in receptor_sets]),
+                   lng=numpy.concatenate([r.lng for r in receptor_sets]))
+
+    def __len__(self):
+        return len(self.id)
+
+    def __getitem__(self, field):
+        return getattr(self, field)
+
+    def __iter__(self):
+        for row in zip(self.id.tolist(), self.x.tolist(), self.y.tolist(), self.lat.tolist(), self.lng.tolist()):
+            yield self.namedtuple_class(*row)
+
+    def take(self, selection):
+        return ReceptorSet(self.id[selection], self.x[selection], self.y[selection],
+                           lat=self.lat[selection], lng=self.lng[selection])
+
+    def merge_nearby(self, tolerance):
+        """
+        Merges receptors within tolerance metres of each other, directly or through a chain of others, into
+        the first of them.  Returns the merged receptors and, for every receptor, the position of the one it
+        was merged into among them.  The set itself is returned when nothing is merged.
+        """
+        if not tolerance or len(self) < 2:
+            return self, numpy.arange(len(self))
+        from scipy import sparse, spatial
+        from scipy.sparse import csgraph
+        pairs = spatial.cKDTree(numpy.column_stack((self.x, self.y))).query_pairs(tolerance, output_type="ndarray")
+        if not len(pairs):
+            return self, numpy.arange(len(self))
+        graph = sparse.coo_matrix((numpy.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])),
+                                  shape=(len(self), len(self)))
+        (_, labels) = csgraph.connected_components(graph, directed=False)
+        first = numpy.empty(labels.max() + 1, dtype=numpy.int64)
+        first.fill(len(self))
+        numpy.minimum.at(first, labels, numpy.arange(len(self)))
+        # Keeping the first receptors in their original order keeps the ids increasing
+        kept = numpy.sort(first)
+        return self.take(kept), numpy.searchsorted(kept, first[labels])
+
+    def index_of(self, ids):
+        """
+        Returns the positions of the given receptor ids within this set, with -1 for unknown ids.
+        """
+        ids = numpy.asarray(ids, dtype=numpy.int64)
+        positions = numpy.searchsorted(self.id, ids)
+        positions[positions >= len(self.id)] = len(self.id) - 1
+        if len(self.id):
+            positions[self.id[positions] != ids] = -1
+        else:
+            positions[:] = -1
+        return positions
+
+
 class Road(Base):
     __tablename__ = "roads"
     fields = ["gid", "id", "sign1", "from_x", "from_y", "to_x", "to_y", "sf_id",
@@ -185,17 +283,14 @@ class AreaSource(Base):
 
     @staticmethod
     def to_vertices(source):
-        results = []
-        for (lng, lat) in source.geom:
-            (x, y) = geo.mercator_to_lcc(lng, lat)
-            results.append(
-                [source.gid, source.sf_id, x, y, null_data(source.nox), null_data(source.benz),
-                 null_data(source.pm2_5),
-                 null_data(source.dies_pm25), null_data(source.ec),
-                 null_data(source.oc), null_data(source.co), null_data(source.form),
-                 null_data(source.ald2), null_data(source.acro), null_data(source.butal_3),
-                 null_data(source.toluene), null_data(source.so2)])
-        return results
+        vertices = numpy.array(source.geom, dtype=numpy.float64).reshape(-1, 2)
+        (xs, ys) = geo.mercator_to_lcc_array(vertices[:, 0], vertices[:, 1])
+        attributes = [null_data(source.nox), null_data(source.benz), null_data(source.pm2_5),
+                      null_data(source.dies_pm25), null_data(source.ec),
+                      null_data(source.oc), null_data(source.co), null_data(source.form),
+                      null_data(source.ald2), null_data(source.acro), null_data(source.butal_3),
+                      null_data(source.toluene), null_data(source.so2)]
+        return [[source.gid, source.sf_id, x, y] + attributes for (x, y) in zip(xs.tolist(), ys.tolist())]
 
 
 class ShipInTransit(Base):
@@ -318,6 +413,17 @@ class Scenario(Base):
     include_railways = sa.Column(sa.Boolean)
     include_roads = sa.Column(sa.Boolean)
     include_ships_in_transit = sa.Column(sa.Boolean)
+    min_lat = sa.Column(sa.Numeric(asdecimal=False))
+    max_lat = sa.Column(sa.Numeric(asdecimal=False))
+    min_lng = sa.Column(sa.Numeric(asdecimal=False))
+    max_lng = sa.Column(sa.Numeric(asdecimal=False))
+
+    # The sources a scenario may include, with the flag including them and the table their rows are laid out as
+    source_lists = [("area_sources", "include_area_sources", AreaSource),
+                    ("point_sources", "include_point_sources", PointSource),
+                    ("roads", "include_roads", Road),
+                    ("railways", "include_railways", Railway),
+                    ("ships_in_transit", "include_ships_in_transit", ShipInTransit)]
 
     @property
     def safe_name(self):
@@ -352,81 +458,65 @@ class Scenario(Base):
             "include_ships_in_transit": self.include_ships_in_transit
         }
 
+    def compute_bounds(self):
+        """
+        Sets the bounding box of the included sources' vertices.  Called whenever a scenario is saved.
+        """
+        vertices = []
+        for (sources, include, table) in self.source_lists:
+            if not getattr(self, include) or not getattr(self, sources):
+                continue
+            geom = table.fields.index("geom")
+            # Point sources have a single (lng, lat); the others a list of them
+            coordinates = (source[geom] for source in getattr(self, sources))
+            if table is not PointSource:
+                coordinates = itertools.chain.from_iterable(coordinates)
+            vertices.append(numpy.fromiter(itertools.chain.from_iterable(coordinates), numpy.float64).reshape(-1, 2))
+        vertices = numpy.concatenate(vertices) if vertices else numpy.empty((0, 2))
+        if len(vertices):
+            (self.min_lng, self.min_lat) = vertices.min(axis=0).tolist()
+            (self.max_lng, self.max_lat) = vertices.max(axis=0).tolist()
+        else:
+            (self.min_lng, self.min_lat, self.max_lng, self.max_lat) = (None, None, None, None)
+
+    @property
+    def bounds(self):
+        """
+        (min_lng, min_lat, max_lng, max_lat), all None for a scenario without sources.  Scenarios saved before
+        their bounds were stored have them computed here.
+        """
+        if self.min_lng is None:
+            self.compute_bounds()
+        return self.min_lng, self.min_lat, self.max_lng, self.max_lat
+
+
+@sa.event.listens_for(Scenario, "before_insert")
+@sa.event.listens_for(Scenario, "before_update")
+def _store_scenario_bounds(mapper, connection, scenario):
+    scenario.compute_bounds()
+
 
 class AbstractScenarioRun(object):
 
+    @classmethod
+    def get_status(cls, scenario_run_id):
+        select = sa.select([cls.__table__.c.status]).where(cls.scenario_run_id == scenario_run_id)
+        return get_engine().execute(select).fetchone()[0]
+
     @property
     def current_status(self):
-        select = sa.select([self.__table__.c.status]).where(type(self).scenario_run_id == self.scenario_run_id)
-        return select.execute().fetchone()[0]
-
-    def _get_bounds_helper(self, scenario):
-        if scenario.include_area_sources:
-            for source in scenario.area_sources:
-                for (lng, lat) in source[16]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_point_sources:
-            for source in scenario.point_sources:
-                (lng, lat) = source[22]
-                if lat < self.min_lat or self.min_lat is None:
-                    self.min_lat = lat
-                if lat > self.max_lat or self.max_lat is None:
-                    self.max_lat = lat
-                if lng < self.min_lng or self.min_lng is None:
-                    self.min_lng = lng
-                if lng > self.max_lng or self.max_lng is None:
-                    self.max_lng = lng
-        if scenario.include_roads:
-            for source in scenario.roads:
-                for (lng, lat) in source[13]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_railways:
-            for source in scenario.railways:
-                for (lng, lat) in source[20]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
-        if scenario.include_ships_in_transit:
-            for source in scenario.ships_in_transit:
-                for (lng, lat) in source[24]:
-                    if lat < self.min_lat or self.min_lat is None:
-                        self.min_lat = lat
-                    if lat > self.max_lat or self.max_lat is None:
-                        self.max_lat = lat
-                    if lng < self.min_lng or self.min_lng is None:
-                        self.min_lng = lng
-                    if lng > self.max_lng or self.max_lng is None:
-                        self.max_lng = lng
+        return self.get_status(self.scenario_run_id)
 
     def _get_bounds(self):
-        self.min_lat = None
-        self.min_lng = None
-        self.max_lat = None
-        self.max_lng = None
-        if isinstance(self, ScenarioRun):
-            self._get_bounds_helper(self.scenario)
+        scenarios = [self.scenario] if isinstance(self, ScenarioRun) else [self.scenario_1, self.scenario_2]
+        bounds = [scenario.bounds for scenario in scenarios if scenario.bounds[0] is not None]
+        if bounds:
+            self.min_lng = min(b[0] for b in bounds)
+            self.min_lat = min(b[1] for b in bounds)
+            self.max_lng = max(b[2] for b in bounds)
+            self.max_lat = max(b[3] for b in bounds)
         else:
-            self._get_bounds_helper(self.scenario_1)
-            self._get_bounds_helper(self.scenario_2)
+            (self.min_lng, self.min_lat, self.max_lng, self.max_lat) = (None, None, None, None)
 
 
 class ScenarioRun(Base, AbstractScenarioRun):
@@ -447,12 +537,14 @@ class ScenarioRun(Base, AbstractScenarioRun):
     max_lat = sa.Column(sa.Numeric(asdecimal=False))
     min_lng = sa.Column(sa.Numeric(asdecimal=False))
     max_lng = sa.Column(sa.Numeric(asdecimal=False))
+    # Where the run spent its time (see metrics.RunMetrics.to_dict)
+    metrics = sa.Column(JSON)
 
     def __init__(self, *args, **kwargs):
         super(ScenarioRun, self).__init__(*args, **kwargs)
         dir_name = str(uuid.uuid4())
         self.output_directory = os.path.join(settings.scenario_run_directory, dir_name)
-        self.results_file_name = "%s.tar.gz" % self.scenario.safe_name
+        self.results_file_name = self.scenario.safe_name + archive.extension(settings.archive_compression)
         try:
             os.mkdir(self.output_directory)
         except OSError:
@@ -484,12 +576,16 @@ class ScenarioRun(Base, AbstractScenarioRun):
     def legend_file(self):
         return os.path.join(self.output_directory, "concentrations_legend.png")
 
+    @property
+    def archive_members(self):
+        return archive.directory_members(self.output_directory)
+
     def finalize_run(self):
         self.status = "completed"
-        starting_dir = os.getcwd()
-        os.chdir(settings.output_tar_directory)
-        subprocess.call(["tar", "-C", self.output_directory, "-czf", self.results_file_name, "."])
-        os.chdir(starting_dir)
+        with metrics.phase("archiving"):
+            archive.write_archive(self.archive_members,
+                                  os.path.join(settings.output_tar_directory, self.results_file_name),
+                                  settings.archive_compression)
 
 
 class ComparisonScenarioRun(Base, AbstractScenarioRun):
@@ -510,6 +606,7 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
     max_lat = sa.Column(sa.Numeric(asdecimal=False))
     min_lng = sa.Column(sa.Numeric(asdecimal=False))
     max_lng = sa.Column(sa.Numeric(asdecimal=False))
+    metrics = sa.Column(JSON)
     scenario_1_id = sa.Column(sa.Integer, sa.ForeignKey("scenario.scenario_id"))
     scenario_2_id = sa.Column(sa.Integer, sa.ForeignKey("scenario.scenario_id"))
     scenario_1 = orm.relationship(Scenario, primaryjoin=scenario_1_id == Scenario.scenario_id)
@@ -517,7 +614,8 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
 
     def __init__(self, *args, **kwargs):
         super(ComparisonScenarioRun, self).__init__(*args, **kwargs)
-        self.results_file_name = "%s_vs_%s.tar.gz" % (self.scenario_1.safe_name, self.scenario_2.safe_name)
+        self.results_file_name = "%s_vs_%s%s" % (self.scenario_1.safe_name, self.scenario_2.safe_name,
+                                                 archive.extension(settings.archive_compression))
         dir_name_1 = str(uuid.uuid4())
         dir_name_2 = str(uuid.uuid4())
         self.output_directory_1 = os.path.join(settings.scenario_run_directory, dir_name_1)
@@ -557,21 +655,88 @@ class ComparisonScenarioRun(Base, AbstractScenarioRun):
     def legend_file(self):
         return os.path.join(self.output_directory_1, "concentrations_legend.png")
 
+    @property
+    def tiles_directory(self):
+        return os.path.join(self.output_directory_1, "tiles")
+
+    @property
+    def archive_members(self):
+        """
+        The image (or, for runs rendered as map tiles, the tile surface), its legend and the comparison results
+        at the top of the archive, and each scenario's inputs and results under a directory named for it, taken
+        straight from the run directories.
+        """
+        if os.path.isdir(self.tiles_directory):
+            members = archive.directory_members(self.tiles_directory, "./tiles")
+        else:
+            members = [(self.image_file, "./concentrations.png")]
+        members.append((self.legend_file, "./concentrations_legend.png"))
+        members += [(filename, "./" + os.path.basename(filename))
+                    for filename in sorted(glob.glob(os.path.join(self.temp_dir, "*.csv")))]
+        for (scenario, output_directory) in ((self.scenario_1, self.output_directory_1),
+                                             (self.scenario_2, self.output_directory_2)):
+            filenames = [os.path.join(output_directory, "CTOOLS_Inputs.txt")]
+            filenames += sorted(glob.glob(os.path.join(output_directory, "*.csv")))
+            members += [(filename, "./%s/%s" % (scenario.safe_name, os.path.basename(filename)))
+                        for filename in filenames]
+        return members
+
     def finalize_run(self):
         self.status = "completed"
-        output_directory_1 = os.path.join(self.temp_dir, self.scenario_1.safe_name)
-        output_directory_2 = os.path.join(self.temp_dir, self.scenario_2.safe_name)
-        os.mkdir(output_directory_1)
-        os.mkdir(output_directory_2)
-        shutil.copy(os.path.join(self.output_directory_1, "concentrations.png"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory_1, "concentrations_legend.png"), self.temp_dir)
-        shutil.copy(os.path.join(self.output_directory_1, "CTOOLS_Inputs.txt"), output_directory_1)
-        for filename in glob.glob(os.path.join(self.output_directory_1, "*.csv")):
-            shutil.copy(filename, output_directory_1)
-        shutil.copy(os.path.join(self.output_directory_2, "CTOOLS_Inputs.txt"), output_directory_2)
-        for filename in glob.glob(os.path.join(self.output_directory_2, "*.csv")):
-            shutil.copy(filename, output_directory_2)
-        starting_dir = os.getcwd()
-        os.chdir(settings.output_tar_directory)
-        subprocess.call(["tar", "-C", self.temp_dir, "-czf", self.results_file_name, "."])
-        os.chdir(starting_dir)
\ No newline at end of file
+        with metrics.phase("archiving"):
+            archive.write_archive(self.archive_members,
+                                  os.path.join(settings.output_tar_directory, self.results_file_name),
+                                  settings.archive_compression)
+
+
+# Status changes on run rows are pushed to running jobs (see supervision.StatusListener) by these triggers
+status_notification_ddl = [sa.DDL("""
+CREATE OR REPLACE FUNCTION notify_scenario_run_status() RETURNS trigger AS $$
+BEGIN
+    IF NEW.status IS DISTINCT FROM OLD.status THEN
+        PERFORM pg_notify('scenario_run_status',
+                          TG_TABLE_NAME || ':' || NEW.scenario_run_id || ':' || COALESCE(NEW.status, ''));
+    END IF;
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql
+""")]
+for table in (ScenarioRun.__table__, ComparisonScenarioRun.__table__):
+    status_notification_ddl.append(sa.DDL(
+        "DROP TRIGGER IF EXISTS %(table)s_status_notify ON %(table)s", context={"table": table.name}))
+    status_notification_ddl.append(sa.DDL(
+        "CREATE TRIGGER %(table)s_status_notify AFTER UPDATE ON %(table)s "
+        "FOR EACH ROW EXECUTE PROCEDURE notify_scenario_run_status()", context={"table": table.name}))
+    sa.event.listen(table, "after_create", status_notification_ddl[0].execute_if(dialect="postgresql"))
+    sa.event.listen(table, "after_create", status_notification_ddl[-1].execute_if(dialect="postgresql"))
+
+
+def install_status_notifications():
+    """
+    Installs the status notification triggers on an existing database.
+    """
+    with get_engine().begin() as connection:
+        for ddl in status_notification_ddl:
+            connection.execute(ddl)
+
+
+def install_scenario_bounds():
+    """
+    Adds the bounding box columns to an existing scenario table and fills them in.
+    """
+    with get_engine().begin() as connection:
+        for column in ("min_lat", "max_lat", "min_lng", "max_lng"):
+            connection.execute("ALTER TABLE scenario ADD COLUMN IF NOT EXISTS %s NUMERIC" % column)
+    session = Session()
+    for scenario in session.query(Scenario).filter(Scenario.min_lng.is_(None)):
+        scenario.compute_bounds()
+    session.commit()
+
+
+def install_run_metrics():
+    """
+    Adds the metrics column to existing scenario run tables.
+    """
+    with get_engine().begin() as connection:
+        for table in (ScenarioRun.__table__, ComparisonScenarioRun.__table__):
+            connection.execute("ALTER TABLE %s ADD COLUMN IF NOT EXISTS metrics JSON" % table.name)
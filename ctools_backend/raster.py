@@ -1,17 +1,72 @@
+import io
 import os
 import numpy as np
 import math
+import threading
+from collections import OrderedDict
 import matplotlib as mpl
 import matplotlib
 
-from ctools_backend import geo
+from ctools_backend import geo, interpolation, metrics, rendering, tiles
 import models
+import settings
 
-matplotlib.use("Agg")  # needs to be before pyplot import
+matplotlib.use("Agg")
 
-from matplotlib import pyplot as plt
-from matplotlib import cm
-from scipy import interpolate
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.colorbar
+
+_legend_cache_size = 64
+_legends = OrderedDict()
+_legends_lock = threading.Lock()
+
+
+def _label(num):
+    if num == 0:
+        return "0"
+    elif num > 0:
+        return "$10^{%d}$" % num
+    else:
+        return "$-10^{%d}$" % abs(num)
+
+
+def _render_legend(key):
+    (legend_text, diverging, kind, min_, max_, ticks) = key
+    # A figure of its own, rather than pyplot's shared state, so that legends can be drawn on any thread
+    fig = Figure(figsize=(0.4, 4))
+    canvas = FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+    if kind == "log":
+        norm = mpl.colors.LogNorm(vmin=min_, vmax=max_)
+    else:
+        norm = mpl.colors.Normalize(vmin=min_, vmax=max_)
+    cmap = mpl.colors.ListedColormap(rendering.colormap_lut(diverging) / 255.0)
+    cb = mpl.colorbar.ColorbarBase(ax, cmap=cmap, norm=norm, ticks=ticks, orientation='vertical')
+    if ticks is not None:
+        cb.ax.set_yticklabels([_label(v) for v in ticks])
+    cb.set_label(legend_text)
+    output = io.BytesIO()
+    canvas.print_figure(output, dpi=100, bbox_inches='tight', format="png")
+    return output.getvalue()
+
+
+def _legend_png(key):
+    """
+    Returns the legend image for a legend text and color scale, rendering it only the first time that
+    legend is asked for.
+    """
+    with _legends_lock:
+        png = _legends.pop(key, None)
+        if png is not None:
+            _legends[key] = png
+            return png
+    png = _render_legend(key)
+    with _legends_lock:
+        _legends[key] = png
+        while len(_legends) > _legend_cache_size:
+            _legends.popitem(last=False)
+    return png
 
 
 class RasterGenerator(object):
@@ -55,9 +110,9 @@ class RasterGenerator(object):
             else:
                 self._legend_text = self.pollutant + " concentration" + units
 
-    def create_pollution_raster(self, concentrations):
+    def create_pollution_raster(self, concentrations, output_mode=None):
         coordinates = concentrations[:, 0:2]
-        lat_lng = np.array([geo.lcc_to_mercator(x, y) for (x, y) in coordinates])
+        lat_lng = np.column_stack(geo.lcc_to_mercator_array(coordinates[:, 0], coordinates[:, 1]))
         conc = concentrations[:, 2]
         # record various information about the data for later use
         max_lat = np.max(lat_lng[:, 1])
@@ -74,27 +129,50 @@ class RasterGenerator(object):
         # This should cause the values in the array to start at the minimum lat/long, and end at the maximum
         interp_lng = interp_lng * lng_step + min_lng
         interp_lat = interp_lat * lat_step + min_lat
-        interp_lat_lng = self.transform_interpolation_grid_to_predictor_input(interp_lat, interp_lng)
-        interp_x_y = np.array([geo.mercator_to_lcc(lng, lat) for (lat, lng) in interp_lat_lng])
         if self.scenario_run.model_min_value:
             conc[conc < self.scenario_run.model_min_value] = self.scenario_run.model_min_value
         if self.scenario_run.model_max_value:
             conc[conc > self.scenario_run.model_max_value] = self.scenario_run.model_max_value
-        results = interpolate.griddata(coordinates, conc, interp_x_y, fill_value=0, method='linear')
-        img_data = self.transform_array_to_image_data(results, len(interp_lng), len(interp_lng[0]))
-        self.create_concentration_image(img_data)
-        self.create_legend_img(concentrations)
+        if (output_mode or settings.raster_output_mode) == "tiles":
+            with metrics.phase("rendering"):
+                self.create_tile_surface(lat_lng, conc)
+                self.create_legend_img(concentrations)
+            return
+        with metrics.phase("interpolation"):
+            # Interpolating in lat/lng space means only the receptors need projecting, not every output pixel
+            interpolator = interpolation.ReceptorInterpolator.for_receptors(lat_lng[:, 0], lat_lng[:, 1])
+            results = interpolator.interpolate(conc, interp_lng, interp_lat, fill_value=0)
+        with metrics.phase("rendering"):
+            img_data = self.transform_array_to_image_data(results, len(interp_lng), len(interp_lng[0]))
+            self.create_concentration_image(img_data)
+            self.create_legend_img(concentrations)
+
+    @property
+    def output_directory(self):
+        if isinstance(self.scenario_run, models.ComparisonScenarioRun):
+            return self.scenario_run.output_directory_1
+        return self.scenario_run.output_directory
+
+    def create_tile_surface(self, lat_lng, conc):
+        """
+        Saves the receptor values for rendering as map tiles on request, in place of concentrations.png.
+        The value range is fixed here, the way create_concentration_image fixes it for the whole image, so
+        that every tile is colored alike.
+        """
+        diverging = self.diverging
+        # The image's range takes in the 0 it fills outside the receptors with
+        (vmin, vmax) = (min(np.min(conc), 0), max(np.max(conc), 0))
+        if diverging:
+            (vmin, vmax) = (-max(abs(vmin), abs(vmax)), max(abs(vmin), abs(vmax)))
+        return tiles.TileSurface.create(os.path.join(self.output_directory, "tiles"), lat_lng[:, 0], lat_lng[:, 1],
+                                        conc, (vmin, vmax), diverging)
 
     @staticmethod
     def transform_array_to_image_data(array, width, height):
         return np.rot90(array.reshape((width, height)))
 
     def create_concentration_image(self, image_data):
-        cmap = cm.get_cmap()
-        cmap._init()
-        is_comparison_run = isinstance(self.scenario_run, models.ComparisonScenarioRun)
-        if not is_comparison_run or self.scenario_run.comparison_mode == "Absolute":
-            alphas = np.abs([min(n, 1.0) for n in np.linspace(0, 2, cmap.N)])
+        if not self.diverging:
             vmax = np.max(image_data)
             vmin = np.min(image_data)
         else:
@@ -106,30 +184,23 @@ class RasterGenerator(object):
             else:
                 vmax = -results_min
                 vmin = results_min
-            results_range = vmax - vmin
-            value_array = np.linspace(vmin, vmax, cmap.N)
-            alphas = np.array([min(np.abs(v) / results_range * 2, 1.0) for v in value_array])
-        cmap._lut[:-3, -1] = alphas
-        if is_comparison_run:
-            output_directory = self.scenario_run.output_directory_1
-        else:
-            output_directory = self.scenario_run.output_directory
-        plt.imsave(fname=os.path.join(output_directory, "concentrations.png"),
-                   arr=image_data, format='png', vmax=vmax, vmin=vmin)
+        rgba = rendering.colorize(image_data, vmin, vmax, self.diverging)
+        rendering.write_png(os.path.join(self.output_directory, "concentrations.png"), rgba)
 
-    def create_legend_img(self, concentrations):
-        def label(num):
-            if num == 0:
-                return "0"
-            elif num > 0:
-                return "$10^{%d}$" % num
-            else:
-                return "$-10^{%d}$" % abs(num)
-        fig, ax = plt.subplots()
-        fig.set_figheight(4)
-        fig.set_figwidth(0.4)
+    @property
+    def diverging(self):
+        # Comparisons other than absolute ones are colored by distance from zero
+        is_comparison_run = isinstance(self.scenario_run, models.ComparisonScenarioRun)
+        return is_comparison_run and self.scenario_run.comparison_mode != "Absolute"
+
+    def _legend_scale(self, concentrations):
+        """
+        Works out the legend's color scale: its kind ("log" or "linear"), the ends of its range, and its
+        ticks (None for the default ticks).
+        """
         min_ = self.scenario_run.model_min_value
         max_ = self.scenario_run.model_max_value
+        ticks = None
         is_comparison_run = isinstance(self.scenario_run, models.ComparisonScenarioRun)
         if is_comparison_run and self.scenario_run.comparison_mode == "Relative":
             if not min_:
@@ -140,11 +211,9 @@ class RasterGenerator(object):
                 min_ = -max_
             else:
                 max_ = -min_
-            norm = mpl.colors.Normalize(vmin=min_, vmax=max_)
             ticks = np.linspace(math.ceil(min_), math.floor(max_),
                                 np.abs(math.ceil(min_)) + np.abs(math.floor(max_)) + 1)
-            cb = mpl.colorbar.ColorbarBase(ax, norm=norm, ticks=ticks, orientation='vertical')
-            cb.ax.set_yticklabels([label(v) for v in ticks])
+            return "linear", min_, max_, tuple(ticks)
         elif is_comparison_run and self.scenario_run.comparison_mode == "Relative (%)":
             if min_ == self.scenario_run.model_min_value:
                 min_ = max(np.min(concentrations[:, 2]), min_)
@@ -154,22 +223,19 @@ class RasterGenerator(object):
                 min_ = -max_
             else:
                 max_ = -min_
-            norm = mpl.colors.Normalize(vmin=min_, vmax=max_)
-            cb = mpl.colorbar.ColorbarBase(ax, norm=norm, orientation='vertical')
-        else:
-            if not min_:
-                min_ = (10 ** np.min(concentrations[:, 2]))
-            if not max_:
-                max_ = (10 ** np.max(concentrations[:, 2]))
-            norm = mpl.colors.LogNorm(vmin=min_, vmax=max_)
-            cb = mpl.colorbar.ColorbarBase(ax, norm=norm, orientation='vertical')
-        cb.set_label(self._legend_text)
-        if is_comparison_run:
-            output_directory = self.scenario_run.output_directory_1
-        else:
-            output_directory = self.scenario_run.output_directory
-        img = os.path.join(output_directory, "concentrations_legend.png")
-        fig.savefig(img, dpi=100, bbox_inches='tight')
+            return "linear", min_, max_, None
+        if not min_:
+            min_ = (10 ** np.min(concentrations[:, 2]))
+        if not max_:
+            max_ = (10 ** np.max(concentrations[:, 2]))
+        return "log", min_, max_, None
+
+    def create_legend_img(self, concentrations):
+        (kind, min_, max_, ticks) = self._legend_scale(concentrations)
+        # The range is rounded to what the legend can show, so that runs with nearly the same range share it
+        key = (self._legend_text, self.diverging, kind, float("%.4g" % min_), float("%.4g" % max_), ticks)
+        with open(os.path.join(self.output_directory, "concentrations_legend.png"), "wb") as f:
+            f.write(_legend_png(key))
 
     @staticmethod
     def build_interpolation_grids(lat_delta, lng_delta, max_size=1600):
@@ -182,7 +248,3 @@ class RasterGenerator(object):
             y_range = np.arange(0, int(max_size * lng_delta / lat_delta))
             (interp_x, interp_y) = np.meshgrid(x_range, y_range)
         return interp_x, interp_y
-
-    @staticmethod
-    def transform_interpolation_grid_to_predictor_input(x_grid, y_grid):
-        return np.array(zip(x_grid.ravel(), y_grid.ravel()))
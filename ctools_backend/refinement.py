@@ -0,0 +1,95 @@
+import numpy
+
+import settings
+
+
+class QuadtreeRefinement(object):
+    """
+    Places receptors adaptively over a bounding box.  Receptors sit on the corners of a quadtree of cells,
+    starting from a grid of initial_cells by initial_cells; each round splits the cells whose corner values
+    differ by more than threshold of the range of all values, steepest first, until the receptor budget is
+    spent or cells reach max_depth.  Corners are kept on an integer lattice at the finest depth, so cells
+    sharing an edge share its receptors.
+    """
+
+    def __init__(self, bounds, initial_cells=None, threshold=None, budget=None, max_depth=None):
+        (self.min_lng, self.min_lat, self.max_lng, self.max_lat) = bounds
+        self.initial_cells = initial_cells or settings.adaptive_initial_cells
+        self.threshold = threshold if threshold is not None else settings.adaptive_refinement_threshold
+        self.budget = budget or settings.adaptive_receptor_budget
+        self.max_depth = max_depth if max_depth is not None else settings.adaptive_max_depth
+        self.lattice_size = self.initial_cells * 2 ** self.max_depth
+        self._corners = {}
+        self._lattice = []
+        self.values = numpy.empty(0)
+        size = 2 ** self.max_depth
+        self._cells = [(i * size, j * size, size) for i in range(self.initial_cells) for j in range(self.initial_cells)]
+        for (i, j, size) in self._cells:
+            self._cell_corners(i, j, size)
+
+    def _corner(self, i, j):
+        corner = self._corners.get((i, j))
+        if corner is None:
+            corner = self._corners[(i, j)] = len(self._lattice)
+            self._lattice.append((i, j))
+        return corner
+
+    def _cell_corners(self, i, j, size):
+        return [self._corner(i, j), self._corner(i + size, j), self._corner(i, j + size),
+                self._corner(i + size, j + size)]
+
+    def __len__(self):
+        return len(self._lattice)
+
+    @property
+    def lat_lng(self):
+        """
+        The latitude and longitude of every receptor placed so far, in the order they were placed.
+        """
+        lattice = numpy.array(self._lattice, dtype=numpy.float64).reshape(-1, 2) / self.lattice_size
+        lng = self.min_lng + lattice[:, 0] * (self.max_lng - self.min_lng)
+        lat = self.min_lat + lattice[:, 1] * (self.max_lat - self.min_lat)
+        return lat, lng
+
+    def add_values(self, values):
+        """
+        Records the values at the receptors placed since values were last added.
+        """
+        self.values = numpy.concatenate((self.values, numpy.asarray(values, dtype=numpy.float64)))
+
+    def refine(self):
+        """
+        Splits the cells that need it, within the budget.  Returns the positions of the receptors placed,
+        which is empty once refinement is done.
+        """
+        first_new = len(self._lattice)
+        if len(self.values) != first_new:
+            raise ValueError("Every receptor needs a value before refining")
+        value_range = self.values.max() - self.values.min() if len(self.values) else 0
+        corners = numpy.array([self._cell_corners(i, j, size) for (i, j, size) in self._cells], dtype=numpy.int64)
+        spreads = self.values[corners].max(axis=1) - self.values[corners].min(axis=1)
+        splittable = numpy.array([size > 1 for (_, _, size) in self._cells], dtype=bool)
+        candidates = numpy.flatnonzero(splittable & (spreads > self.threshold * value_range))
+        split = set()
+        for cell in candidates[numpy.argsort(-spreads[candidates], kind="mergesort")]:
+            (i, j, size) = self._cells[cell]
+            half = size // 2
+            placed = len(self._lattice)
+            for (di, dj) in ((half, 0), (0, half), (half, half), (size, half), (half, size)):
+                self._corner(i + di, j + dj)
+            if len(self._lattice) > self.budget:
+                # Undo the partial split; cells are split whole or not at all
+                for point in self._lattice[placed:]:
+                    del self._corners[point]
+                del self._lattice[placed:]
+                break
+            split.add(cell)
+        cells = []
+        for (cell, (i, j, size)) in enumerate(self._cells):
+            if cell in split:
+                half = size // 2
+                cells.extend([(i, j, half), (i + half, j, half), (i, j + half, half), (i + half, j + half, half)])
+            else:
+                cells.append((i, j, size))
+        self._cells = cells
+        return numpy.arange(first_new, len(self._lattice))
@@ -0,0 +1,76 @@
+import struct
+import threading
+import zlib
+
+import numpy as np
+
+_lut_size = 256
+_luts = {}
+_luts_lock = threading.Lock()
+
+
+def colormap_lut(diverging=False):
+    """
+    Returns the RGBA lookup table concentration images are colored with: the default colormap, with
+    transparency rising over the bottom half of the value range, or with distance from the middle of the
+    range for diverging (comparison) images.  Tables are built once per process and are read only, so they
+    can be shared between threads; the colormap itself is never modified.
+    """
+    lut = _luts.get(diverging)
+    if lut is None:
+        with _luts_lock:
+            lut = _luts.get(diverging)
+            if lut is None:
+                from matplotlib import cm
+                colors = cm.get_cmap(lut=_lut_size)(np.arange(_lut_size))
+                if diverging:
+                    colors[:, 3] = np.minimum(np.abs(np.linspace(-1, 1, _lut_size)), 1.0)
+                else:
+                    colors[:, 3] = np.minimum(np.linspace(0, 2, _lut_size), 1.0)
+                lut = (colors * 255).astype(np.uint8)
+                lut.flags.writeable = False
+                _luts[diverging] = lut
+    return lut
+
+
+def colorize(values, vmin, vmax, diverging=False):
+    """
+    Maps values to RGBA bytes through colormap_lut, with vmin and vmax at either end of the table.  NaNs
+    are fully transparent.
+    """
+    values = np.asarray(values, dtype=np.float64)
+    lut = colormap_lut(diverging)
+    with np.errstate(invalid="ignore"):
+        if vmax > vmin:
+            indices = (values - vmin) / (vmax - vmin) * len(lut)
+        else:
+            indices = np.zeros_like(values)
+        indices = np.clip(np.nan_to_num(indices), 0, len(lut) - 1).astype(np.intp)
+    rgba = lut[indices]
+    rgba[np.isnan(values)] = 0
+    return rgba
+
+
+def _chunk(kind, data):
+    return struct.pack(">I", len(data)) + kind + data + struct.pack(">I", zlib.crc32(kind + data) & 0xffffffff)
+
+
+def encode_png(rgba, compression=6):
+    """
+    Encodes an (height, width, 4) array of bytes as an RGBA PNG.
+    """
+    rgba = np.ascontiguousarray(rgba, dtype=np.uint8)
+    (height, width) = rgba.shape[:2]
+    # Every scanline starts with its filter type, 0 for none
+    scanlines = np.empty((height, width * 4 + 1), dtype=np.uint8)
+    scanlines[:, 0] = 0
+    scanlines[:, 1:] = rgba.reshape(height, width * 4)
+    return b"".join([b"\x89PNG\r\n\x1a\n",
+                     _chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)),
+                     _chunk(b"IDAT", zlib.compress(scanlines.tobytes(), compression)),
+                     _chunk(b"IEND", b"")])
+
+
+def write_png(file_name, rgba):
+    with open(file_name, "wb") as f:
+        f.write(encode_png(rgba))
@@ -0,0 +1,199 @@
+import errno
+import fcntl
+import glob
+import hashlib
+import os
+import threading
+
+import numpy
+
+from ctools_backend import tables
+import settings
+
+
+def coordinate_keys(x, y):
+    # Receptors are matched on their coordinates to the centimetre; complex numbers sort and search on
+    # (x, y) pairs without any Python level work
+    return numpy.round(numpy.asarray(x) * 100) + 1j * numpy.round(numpy.asarray(y) * 100)
+
+
+class CacheLock(object):
+    """
+    An exclusive lock on one cache key, held while the results for that key are computed.  It is an
+    flock on a lock file, so it coalesces identical runs across worker processes as well as threads, and
+    is released by the operating system if its holder dies.
+    """
+
+    def __init__(self, file_name):
+        while True:
+            self._file = open(file_name, "a")
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+            # Eviction removes unused lock files (see ResultCache._evict); one removed while this waited
+            # on it no longer locks anything, so the lock is taken again on the file now at file_name
+            try:
+                if os.path.samestat(os.fstat(self._file.fileno()), os.stat(file_name)):
+                    return
+            except OSError as e:
+                if e.errno != errno.ENOENT:
+                    self._file.close()
+                    raise
+            self._file.close()
+
+    def release(self):
+        if self._file is not None:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class ResultCache(object):
+    """
+    A content addressed, size bounded cache of CTOOLS results.  Results are keyed by a hash of everything
+    a source type's run reads (the program, CTOOLS_Inputs.txt and the source file), and stored per
+    receptor, so a run whose receptors only partly match an earlier one reuses the receptors they have
+    in common.  Least recently used entries are evicted once the cache grows past max_bytes.
+    """
+
+    def __init__(self, directory=None, max_bytes=None):
+        self.directory = directory or settings.result_cache_directory
+        self.max_bytes = max_bytes or settings.result_cache_max_bytes
+        try:
+            os.makedirs(self.directory)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+        self._eviction_lock = threading.Lock()
+
+    @staticmethod
+    def key(program, *input_files):
+        digest = hashlib.sha1()
+        program_stat = os.stat(program)
+        # A rebuilt binary invalidates everything it computed
+        digest.update("%s:%d:%d\n" % (os.path.realpath(program), program_stat.st_size, program_stat.st_mtime))
+        for input_file in input_files:
+            digest.update(os.path.basename(input_file) + "\n")
+            with open(input_file, "rb") as f:
+                for block in iter(lambda: f.read(1 << 20), b""):
+                    digest.update(block)
+        return digest.hexdigest()
+
+    def _entry_file(self, key):
+        return os.path.join(self.directory, key + ".npz")
+
+    def _lock_file(self, key):
+        return os.path.join(self.directory, key + ".lock")
+
+    def lock(self, key):
+        """
+        Blocks until no one else is computing results for key, then returns a CacheLock to release once
+        this caller's results are stored.
+        """
+        return CacheLock(self._lock_file(key))
+
+    def lock_all(self, keys):
+        """
+        Locks every distinct key, returning a dictionary of their CacheLocks.  Keys are always locked in
+        sorted order, so callers that each lock all of their keys this way wait for one another rather than
+        deadlocking, however their keys overlap.
+        """
+        locks = {}
+        try:
+            for key in sorted(set(keys)):
+                locks[key] = self.lock(key)
+        except Exception:
+            for lock in locks.values():
+                lock.release()
+            raise
+        return locks
+
+    def _load(self, key):
+        try:
+            with numpy.load(self._entry_file(key)) as entry:
+                return list(entry["headers"]), entry["coordinates"], entry["rows"]
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+
+    def lookup(self, key, receptors):
+        """
+        Finds cached results for the receptors.  Returns the output headers, a row of output values (less
+        the receptor id) per receptor, and a mask of the receptors that had no cached row; or None if
+        nothing is cached under key.
+        """
+        entry = self._load(key)
+        if entry is None:
+            return None
+        (headers, coordinates, cached_rows) = entry
+        os.utime(self._entry_file(key), None)
+        wanted = coordinate_keys(receptors.x, receptors.y)
+        positions = numpy.minimum(numpy.searchsorted(coordinates, wanted), max(len(coordinates) - 1, 0))
+        found = coordinates[positions] == wanted if len(coordinates) else numpy.zeros(len(wanted), dtype=bool)
+        rows = numpy.empty((len(receptors), cached_rows.shape[1]))
+        rows.fill(numpy.nan)
+        rows[found] = cached_rows[positions[found]]
+        return headers, rows, ~found
+
+    def store(self, key, receptors, output_file):
+        """
+        Adds the rows of a CTOOLS output file, computed for the given receptors, to the entry for key.
+        """
+        with open(output_file) as f:
+            headers = [h.strip() for h in f.readline().split(",")]
+        columns = tables.read_csv_columns(output_file, range(len(headers)))
+        positions = receptors.index_of(columns[0].astype(numpy.int64))
+        known = positions >= 0
+        coordinates = coordinate_keys(receptors.x[positions[known]], receptors.y[positions[known]])
+        rows = numpy.column_stack(columns[1:])[known]
+        entry = self._load(key)
+        if entry is not None and entry[0] == headers:
+            # Newer rows win where the coordinates overlap
+            coordinates = numpy.concatenate((coordinates, entry[1]))
+            rows = numpy.concatenate((rows, entry[2]))
+        (coordinates, first) = numpy.unique(coordinates, return_index=True)
+        temporary_file = "%s.%d.%d.tmp" % (self._entry_file(key), os.getpid(), threading.current_thread().ident)
+        with open(temporary_file, "wb") as f:
+            numpy.savez(f, headers=numpy.array(headers), coordinates=coordinates, rows=rows[first])
+        os.rename(temporary_file, self._entry_file(key))
+        self._evict()
+
+    def _evict(self):
+        with self._eviction_lock:
+            entries = []
+            for file_name in glob.glob(os.path.join(self.directory, "*.npz")):
+                try:
+                    stat = os.stat(file_name)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, file_name))
+            total = sum(size for (_, size, _) in entries)
+            for (_, size, file_name) in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(file_name)
+                except OSError:
+                    pass
+                total -= size
+            # Lock files of keys with no entry, whether evicted or never stored, are removed unless in use
+            for file_name in glob.glob(os.path.join(self.directory, "*.lock")):
+                if not os.path.exists(os.path.splitext(file_name)[0] + ".npz"):
+                    _remove_unused_lock_file(file_name)
+
+
+def _remove_unused_lock_file(file_name):
+    # The file is removed while locked, so that anyone who opened it meanwhile takes the lock afresh (see
+    # CacheLock); a lock someone holds, including this thread, is left alone
+    try:
+        with open(file_name, "a") as f:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+            os.remove(file_name)
+    except (IOError, OSError):
+        pass
+
+
+def write_output(file_name, headers, receptors, rows):
+    """
+    Writes cached rows back out as a CTOOLS output file for the given receptors, skipping receptors
+    without a row.
+    """
+    found = ~numpy.isnan(rows).all(axis=1)
+    tables.write_csv(file_name, headers, [receptors.id[found]] + [rows[found, i] for i in range(rows.shape[1])])
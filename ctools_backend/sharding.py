@@ -0,0 +1,128 @@
+import os
+import shutil
+import multiprocessing
+
+import numpy
+
+from ctools_backend import tables
+import settings
+
+
+def default_worker_count():
+    if settings.ctools_workers:
+        return settings.ctools_workers
+    try:
+        return multiprocessing.cpu_count()
+    except NotImplementedError:
+        return 1
+
+
+def receptor_shard_count(receptor_count, shards=None):
+    """
+    Works out how many shards to split a receptor set into.  An explicit count wins; otherwise there is a
+    shard per core, as long as every shard keeps at least settings.min_receptors_per_shard receptors.
+    """
+    if shards is None:
+        shards = settings.receptor_shards
+    if shards is None:
+        by_size = receptor_count // max(settings.min_receptors_per_shard, 1)
+        shards = min(default_worker_count(), by_size)
+    return int(max(min(shards, receptor_count), 1))
+
+
+def split(count, shards):
+    """
+    Splits range(count) into contiguous, nearly equal slices.
+    """
+    bounds = numpy.linspace(0, count, shards + 1).astype(numpy.int64)
+    return [slice(start, end) for (start, end) in zip(bounds[:-1], bounds[1:])]
+
+
+def link(source, destination):
+    # Shards share the run's input files; hard links avoid copying them where the filesystem allows it
+    try:
+        os.link(source, destination)
+    except OSError:
+        shutil.copyfile(source, destination)
+
+
+def stitch_outputs(shard_files, file_name):
+    """
+    Combines the output files of receptor shards into one output file ordered by receptor id.  The
+    header is taken from the first shard and the data lines are copied through untouched.
+    """
+    header = None
+    ids = []
+    lines = []
+    for shard_file in shard_files:
+        with open(shard_file) as f:
+            shard_header = f.readline()
+            if header is None:
+                header = shard_header
+            shard_lines = [line if line.endswith("\n") else line + "\n" for line in f if line.strip()]
+        ids.append(numpy.array([int(line.split(",", 1)[0]) for line in shard_lines], dtype=numpy.int64))
+        lines.extend(shard_lines)
+    ids = numpy.concatenate(ids) if ids else numpy.empty(0, dtype=numpy.int64)
+    order = numpy.argsort(ids, kind="mergesort")
+    with open(file_name, "w", 1 << 20) as f:
+        f.write(header or "")
+        if numpy.all(order == numpy.arange(len(order))):
+            f.writelines(lines)
+        else:
+            f.writelines(lines[i] for i in order)
+
+
+def source_chunk_count(source_count, chunks=None):
+    """
+    Works out how many chunks to split a source file into.  An explicit count wins; otherwise chunks hold
+    at most settings.max_sources_per_chunk sources.
+    """
+    if chunks is None:
+        chunks = settings.source_chunks
+    if chunks is None:
+        chunks = -(-source_count // max(settings.max_sources_per_chunk, 1))
+    return int(max(min(chunks, source_count), 1))
+
+
+def sum_outputs(chunk_files, file_name, first_value_column=3):
+    """
+    Combines the output files of source chunks run over the same receptors into one output file.
+    Dispersion is linear in the sources, so every value column (those from first_value_column on) is
+    summed per receptor id; the columns before it, such as the receptor coordinates, are taken from the
+    first chunk that has the receptor.
+    """
+    with open(chunk_files[0]) as f:
+        headers = [h.strip() for h in f.readline().split(",")]
+    column_count = len(headers)
+    chunks = [tables.read_csv_columns(chunk_file, range(column_count)) for chunk_file in chunk_files]
+    ids = numpy.concatenate([chunk[0] for chunk in chunks]).astype(numpy.int64)
+    (unique_ids, first_rows, positions) = numpy.unique(ids, return_index=True, return_inverse=True)
+    columns = [unique_ids]
+    for column in range(1, column_count):
+        values = numpy.concatenate([chunk[column] for chunk in chunks])
+        if column < first_value_column:
+            columns.append(values[first_rows])
+        else:
+            columns.append(numpy.bincount(positions, weights=values, minlength=len(unique_ids)))
+    tables.write_csv(file_name, headers, columns)
+
+
+def expand_output(file_name, merged_receptors, receptors, merged_into):
+    """
+    Rewrites an output file computed over merged receptors (see models.ReceptorSet.merge_nearby) for the
+    receptors they were merged from, merged_into giving the position of each receptor's merged receptor.
+    Every receptor takes the values of its merged receptor, under its own id and coordinates.
+    """
+    with open(file_name) as f:
+        headers = [h.strip() for h in f.readline().split(",")]
+    columns = tables.read_csv_columns(file_name, range(len(headers)))
+    positions = merged_receptors.index_of(columns[0].astype(numpy.int64))
+    known = positions >= 0
+    rows = numpy.empty(len(merged_receptors), dtype=numpy.int64)
+    rows.fill(-1)
+    rows[positions[known]] = numpy.flatnonzero(known)
+    rows = rows[merged_into]
+    found = rows >= 0
+    rows = rows[found]
+    tables.write_csv(file_name, headers, [receptors.id[found], receptors.x[found], receptors.y[found]] +
+                     [column[rows] for column in columns[3:]])
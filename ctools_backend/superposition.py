@@ -0,0 +1,162 @@
+import os
+import threading
+from collections import Counter
+
+import numpy
+
+from ctools_backend import sharding, tables
+import settings
+
+# The vehicle classes a road's emissions are split into, each scaled by its own multiplier
+multiplier_fields = ("gas_car_multiplier", "gas_truck_multiplier", "diesel_car_multiplier", "diesel_truck_multiplier")
+
+
+class RoadSuperposition(object):
+    """
+    Evaluates a ROAD run as a superposition of cached contributions.  Dispersion is linear in the emissions,
+    and a road's emissions are linear in its vehicle class multipliers, so the road segments are split into
+    groups of settings.superposition_group_size, and each group is run once per class with that class's
+    multiplier at 1 and the others at 0.  The outputs are kept in the result cache directory as sparse
+    transfer matrices from multipliers to receptor values, keyed by everything the runs read except the
+    multipliers, so a scenario that only changes multipliers costs a sparse matrix-vector product rather
+    than a model run.  A group is evaluated at the multipliers most of its segments share, and the segments
+    whose multipliers differ are run directly, with multipliers of the difference, so editing a few links
+    only costs a model run of those links.
+    """
+
+    def __init__(self, cache, program, inputs_file, receptor_file, receptors, roads, ignored_fields, output_file,
+                 directory):
+        self.cache = cache
+        self.program = program
+        self.inputs_file = inputs_file
+        self.receptor_file = receptor_file
+        self.receptors = receptors
+        self.roads = roads
+        self.ignored_fields = ignored_fields
+        self.output_file = output_file
+        self.directory = directory
+        group_count = -(-len(roads) // max(settings.superposition_group_size, 1))
+        self.groups = sharding.split(len(roads), max(group_count, 1))
+        self._weights = {}
+        self._matrices = {}
+        self._unit_runs = []
+        self._direct_directory = None
+
+    def _transfer_file(self, key):
+        # Kept beside the cached results, so that they are evicted along with them
+        return os.path.join(self.cache.directory, "transfer-%s.npz" % key)
+
+    def _work_directory(self, name, roads):
+        directory = os.path.join(self.directory, name)
+        os.makedirs(directory)
+        sharding.link(self.inputs_file, os.path.join(directory, os.path.basename(self.inputs_file)))
+        sharding.link(self.receptor_file, os.path.join(directory, os.path.basename(self.receptor_file)))
+        fields = [f for f in roads.fields if f not in self.ignored_fields]
+        tables.write_csv(os.path.join(directory, "roads.csv"), fields, [roads[f] for f in fields])
+        return directory
+
+    def prepare(self):
+        """
+        Loads the transfer matrices already cached and writes out the model runs still needed.  Returns the
+        directories to run ROAD in.
+        """
+        multipliers = numpy.column_stack([self.roads[f] for f in multiplier_fields]).astype(numpy.float64)
+        direct_rows = []
+        direct_multipliers = []
+        for (group, rows) in enumerate(self.groups):
+            group_multipliers = multipliers[rows]
+            base = numpy.array(Counter(map(tuple, group_multipliers.tolist())).most_common(1)[0][0])
+            differs = (group_multipliers != base).any(axis=1)
+            if differs.any():
+                direct_rows.append(rows.start + numpy.flatnonzero(differs))
+                direct_multipliers.append(group_multipliers[differs] - base)
+            self._weights[group] = base
+            roads = self.roads.take(numpy.arange(rows.start, rows.stop))
+            for field in multiplier_fields:
+                roads.columns[field] = numpy.zeros(len(roads))
+            directory = self._work_directory("group-%d" % group, roads)
+            key = self.cache.key(self.program, self.inputs_file, self.receptor_file,
+                                 os.path.join(directory, "roads.csv"))
+            matrix = self._load(key)
+            if matrix is not None:
+                self._matrices[group] = matrix
+                continue
+            for (i, field) in enumerate(multiplier_fields):
+                roads.columns[field] = numpy.ones(len(roads))
+                self._unit_runs.append((group, key, self._work_directory("group-%d-%d" % (group, i), roads)))
+                roads.columns[field] = numpy.zeros(len(roads))
+        if direct_rows:
+            roads = self.roads.take(numpy.concatenate(direct_rows))
+            for (i, column) in enumerate(numpy.vstack(direct_multipliers).T):
+                roads.columns[multiplier_fields[i]] = column
+            self._direct_directory = self._work_directory("direct", roads)
+        directories = [directory for (_, _, directory) in self._unit_runs]
+        if self._direct_directory is not None:
+            directories.append(self._direct_directory)
+        return directories
+
+    def _load(self, key):
+        from scipy import sparse
+        try:
+            with numpy.load(self._transfer_file(key)) as entry:
+                matrix = sparse.csc_matrix((entry["data"], entry["indices"], entry["indptr"]),
+                                           shape=tuple(entry["shape"]))
+                headers = list(entry["headers"])
+        except (IOError, OSError, KeyError, ValueError):
+            return None
+        if matrix.shape[0] != len(self.receptors):
+            return None
+        os.utime(self._transfer_file(key), None)
+        return headers, matrix
+
+    def _store(self, key, headers, matrix):
+        temporary_file = "%s.%d.%d.tmp" % (self._transfer_file(key), os.getpid(), threading.current_thread().ident)
+        with open(temporary_file, "wb") as f:
+            numpy.savez(f, headers=numpy.array(headers), data=matrix.data, indices=matrix.indices,
+                        indptr=matrix.indptr, shape=numpy.array(matrix.shape))
+        os.rename(temporary_file, self._transfer_file(key))
+
+    def _read_output(self, directory):
+        # Returns an output file's headers and its values, a row per receptor in receptor order
+        output_file = os.path.join(directory, os.path.basename(self.output_file))
+        with open(output_file) as f:
+            headers = [h.strip() for h in f.readline().split(",")]
+        columns = tables.read_csv_columns(output_file, range(len(headers)))
+        positions = self.receptors.index_of(columns[0].astype(numpy.int64))
+        known = positions >= 0
+        values = numpy.zeros((len(self.receptors), len(headers) - 3))
+        values[positions[known]] = numpy.column_stack(columns[3:])[known]
+        return headers, values
+
+    def finish(self):
+        """
+        Stores the transfer matrices of the groups just run, and writes the output of the whole ROAD run.
+        """
+        from scipy import sparse
+        unit_values = {}
+        headers = None
+        for (group, key, directory) in self._unit_runs:
+            (headers, values) = self._read_output(directory)
+            unit_values.setdefault(group, (key, []))[1].append(values)
+        for (group, (key, values)) in unit_values.items():
+            # Columns run over the value columns, and over the vehicle classes within each
+            matrix = numpy.dstack(values).reshape(len(self.receptors), -1)
+            matrix[numpy.abs(matrix) <= settings.superposition_tolerance * numpy.abs(matrix).max(axis=0)] = 0
+            matrix = sparse.csc_matrix(matrix)
+            self._store(key, headers, matrix)
+            self._matrices[group] = (headers, matrix)
+        if self._direct_directory is not None:
+            (headers, values) = self._read_output(self._direct_directory)
+        else:
+            headers = headers or self._matrices.values()[0][0]
+            values = numpy.zeros((len(self.receptors), len(headers) - 3))
+        groups = sorted(self._matrices)
+        if groups:
+            transfer = sparse.hstack([self._matrices[group][1] for group in groups]).tocsr()
+            class_count = len(multiplier_fields)
+            for column in range(values.shape[1]):
+                weights = numpy.zeros((len(groups), values.shape[1], class_count))
+                weights[:, column, :] = [self._weights[group] for group in groups]
+                values[:, column] += transfer.dot(weights.ravel())
+        tables.write_csv(self.output_file, headers, [self.receptors.id, self.receptors.x, self.receptors.y] +
+                         [values[:, column] for column in range(values.shape[1])])
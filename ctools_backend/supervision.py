@@ -0,0 +1,300 @@
+import Queue
+import errno
+import logging
+import os
+import select
+import subprocess
+import threading
+import time
+
+from ctools_backend import metrics
+import settings
+import models
+
+logger = logging.getLogger(__name__)
+
+
+class ProcessSlots(object):
+    """
+    A limit on how many children the supervisors sharing it run at once, so that runs on several threads
+    of a process do not each start a child per core.  A supervisor waiting for a slot is woken on its
+    event queue when one is given back.
+    """
+
+    def __init__(self, count):
+        self.count = count
+        self._available = count
+        self._waiting = []
+        self._lock = threading.Lock()
+
+    def acquire(self, events):
+        """
+        Takes a slot if one is free.  Otherwise returns False, and ("slot", None) is put on events once one
+        is given back.
+        """
+        with self._lock:
+            if self._available > 0:
+                self._available -= 1
+                return True
+            if events not in self._waiting:
+                self._waiting.append(events)
+            return False
+
+    def release(self):
+        with self._lock:
+            self._available += 1
+            (waiting, self._waiting) = (self._waiting, [])
+        for events in waiting:
+            events.put(("slot", None))
+
+
+class ProcessSupervisor(object):
+    """
+    Runs a group of child processes and waits for them to exit without polling.  Each child gets a
+    watcher thread that blocks on its exit and reports it on an event queue; cancellation requests arrive
+    on the same queue, so the supervisor wakes up exactly when there is something to do.  When
+    max_running is given, at most that many children run at once and the rest wait their turn.  Children
+    given a name have their wall time, CPU time and peak resident memory recorded in the metrics being
+    collected on the thread that created the supervisor (see metrics.collect).  Supervisors given the
+    same ProcessSlots also share its limit.
+    """
+
+    def __init__(self, max_running=None, slots=None):
+        self.max_running = max_running
+        self.slots = slots
+        self.metrics = metrics.current()
+        self._events = Queue.Queue()
+        self._pending = []
+        self._processes = []
+        self.cancelled = False
+
+    def submit(self, args, name=None, **popen_kwargs):
+        """
+        Queues a child process, which is started by wait() once a slot is free.  Returns the position of
+        the child's return code in the list returned by wait().  popen_kwargs are passed on to Popen; children
+        should be given their working directory as cwd rather than changing this process's.
+        """
+        self._pending.append((args, name, popen_kwargs))
+        return len(self._pending) - 1
+
+    def _start(self, args, name, popen_kwargs):
+        process = subprocess.Popen(args, **popen_kwargs)
+        self._processes.append(process)
+        watcher = threading.Thread(target=self._watch, args=(process, name, time.time()))
+        watcher.daemon = True
+        watcher.start()
+        return process
+
+    def _watch(self, process, name, started):
+        recording = name is not None and self.metrics is not None
+        if recording:
+            exited = threading.Event()
+            peak_rss = [0]
+            sampler = threading.Thread(target=self._sample_peak_rss, args=(process.pid, exited, peak_rss))
+            sampler.daemon = True
+            sampler.start()
+        # The child is reaped with wait4 rather than process.wait(), as that is when the kernel hands over
+        # its CPU time
+        usage = None
+        while True:
+            try:
+                (_, status, usage) = os.wait4(process.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                process.wait()
+            else:
+                process.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            break
+        if recording:
+            exited.set()
+            sampler.join()
+            if usage is not None:
+                self.metrics.record_binary(name, time.time() - started, usage.ru_utime + usage.ru_stime, peak_rss[0])
+        # Given back here rather than by wait(), which may have stopped waiting on an error
+        if self.slots is not None:
+            self.slots.release()
+        self._events.put(("exit", process))
+
+    @staticmethod
+    def _sample_peak_rss(pid, exited, peak_rss):
+        # The child's high water mark is read from /proc while it runs, as its ru_maxrss starts from the
+        # resident size of this process, which it was forked from.  Samples start often and slow down to
+        # settings.metrics_sample_interval, so that short runs are sampled too
+        interval = 0.01
+        while not exited.wait(interval):
+            peak_rss[0] = max(peak_rss[0], metrics.process_peak_rss(pid))
+            interval = min(interval * 2, settings.metrics_sample_interval)
+
+    def cancel(self):
+        """
+        Asks the supervisor to terminate its children.  Safe to call from any thread.
+        """
+        self._events.put(("cancel", None))
+
+    @staticmethod
+    def _tick(events, interval, stopped):
+        # Sleeps rather than waiting on stopped, which in Python 2 wakes up every few milliseconds
+        while True:
+            time.sleep(interval)
+            if stopped.is_set():
+                return
+            events.put(("poll", None))
+
+    def wait(self, poll=None, poll_interval=None):
+        """
+        Runs the queued children and blocks until every one has exited.  If cancel() is called in the
+        meantime the running children are terminated and the queued ones are dropped.  poll, if given, is
+        called every poll_interval seconds (by default settings.status_poll_interval) while waiting, and
+        may call cancel().  Returns the return codes of the children that were started, in the order they
+        were submitted.
+        """
+        running = set()
+        self._pending.reverse()
+        stopped = threading.Event()
+        if poll is not None:
+            ticker = threading.Thread(target=self._tick, args=(
+                self._events, poll_interval or settings.status_poll_interval, stopped))
+            ticker.daemon = True
+            ticker.start()
+        try:
+            return self._wait(running, poll)
+        finally:
+            stopped.set()
+
+    def _wait(self, running, poll):
+        while True:
+            while self._pending and not self.cancelled and (
+                    self.max_running is None or len(running) < self.max_running) and (
+                    self.slots is None or self.slots.acquire(self._events)):
+                try:
+                    running.add(self._start(*self._pending.pop()))
+                except Exception:
+                    if self.slots is not None:
+                        self.slots.release()
+                    raise
+            if not running and not self._pending:
+                break
+            (event, process) = self._events.get()
+            if event == "exit":
+                running.discard(process)
+            elif event == "poll":
+                poll()
+            elif event == "cancel" and not self.cancelled:
+                self.cancelled = True
+                del self._pending[:]
+                for p in running:
+                    try:
+                        p.terminate()
+                    except OSError:
+                        pass
+        return [p.returncode for p in self._processes]
+
+
+class StatusListener(object):
+    """
+    Delivers scenario run status changes pushed by Postgres.  A single background thread LISTENs on the
+    channel written to by the triggers in models.status_notification_ddl and dispatches each notification
+    to whoever subscribed to that run.
+    """
+    channel = "scenario_run_status"
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def subscribe(self, table_name, scenario_run_id, callback):
+        key = (table_name, str(scenario_run_id))
+        with self._lock:
+            self._subscriptions.setdefault(key, []).append(callback)
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._listen)
+                self._thread.daemon = True
+                self._thread.start()
+        return key, callback
+
+    def unsubscribe(self, subscription):
+        (key, callback) = subscription
+        with self._lock:
+            callbacks = self._subscriptions.get(key, [])
+            if callback in callbacks:
+                callbacks.remove(callback)
+            if not callbacks:
+                self._subscriptions.pop(key, None)
+
+    def _dispatch(self, payload):
+        (table_name, scenario_run_id, status) = payload.split(":", 2)
+        with self._lock:
+            callbacks = list(self._subscriptions.get((table_name, scenario_run_id), []))
+        for callback in callbacks:
+            self._call(callback, status)
+
+    def _resync(self):
+        # Changes made while the listener was not yet (or no longer) connected were never pushed, so every
+        # subscriber is told to look the status up once
+        with self._lock:
+            callbacks = [c for callbacks in self._subscriptions.values() for c in callbacks]
+        for callback in callbacks:
+            self._call(callback, None)
+
+    @staticmethod
+    def _call(callback, status):
+        try:
+            callback(status)
+        except Exception:
+            logger.exception("Scenario run status callback failed")
+
+    def _connect(self):
+        connection = models.get_engine().raw_connection()
+        # The listening connection lives for the life of the process, so it is taken out of the pool
+        connection.detach()
+        dbapi_connection = connection.connection
+        dbapi_connection.autocommit = True
+        dbapi_connection.cursor().execute("LISTEN %s" % self.channel)
+        return dbapi_connection
+
+    def _listen(self):
+        retry_delay = 1
+        while True:
+            connection = None
+            try:
+                connection = self._connect()
+                retry_delay = 1
+                self._resync()
+                while True:
+                    if select.select([connection], [], [], 60) == ([], [], []):
+                        continue
+                    connection.poll()
+                    while connection.notifies:
+                        self._dispatch(connection.notifies.pop(0).payload)
+            except Exception:
+                logger.exception("Lost the scenario run status listener connection, reconnecting")
+                if connection is not None:
+                    try:
+                        connection.close()
+                    except Exception:
+                        pass
+                time.sleep(retry_delay)
+                retry_delay = min(retry_delay * 2, 60)
+
+
+_status_listener = StatusListener()
+
+
+def watch_status(table_name, scenario_run_id, callback):
+    """
+    Calls callback with the new status whenever the scenario run's status changes, or with None when a
+    change may have been missed and the status should be looked up.  The callback runs on the listener
+    thread.  Returns a subscription for unwatch_status, or None when status notifications are turned off.
+    """
+    if not settings.status_notifications:
+        return None
+    return _status_listener.subscribe(table_name, scenario_run_id, callback)
+
+
+def unwatch_status(subscription):
+    if subscription is not None:
+        _status_listener.unsubscribe(subscription)
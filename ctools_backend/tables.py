@@ -0,0 +1,276 @@
+import numpy
+import sqlalchemy as sa
+from geoalchemy2 import Geometry
+
+from ctools_backend import geo
+import settings
+
+null_value = -999
+
+# Name columns are written into space/comma separated model files, so they are cleaned up on load
+_name_fields = ("facility", "pltname")
+
+
+def _mapped_columns(type_, field):
+    return getattr(getattr(getattr(type_, field, None), "property", None), "columns", None)
+
+
+def _column_kind(type_, field):
+    """
+    Works out how a field is stored from the model's column type.  Fields that are not mapped columns,
+    such as the road emission multipliers, are treated as floats.
+    """
+    columns = _mapped_columns(type_, field)
+    if not columns:
+        return "float"
+    column_type = columns[0].type
+    if isinstance(column_type, Geometry):
+        return "geom"
+    elif isinstance(column_type, sa.Boolean):
+        return "object"
+    elif isinstance(column_type, sa.Integer):
+        return "int"
+    elif isinstance(column_type, sa.String):
+        return "object"
+    return "float"
+
+
+def _clean_name(name):
+    if name is None:
+        return null_value
+    return name.replace(" ", "_").replace(",", "")
+
+
+def _to_column(kind, values):
+    if kind == "object":
+        column = numpy.empty(len(values), dtype=object)
+        column[:] = [null_value if v is None else v for v in values]
+        return column
+    dtype = numpy.int64 if kind == "int" else numpy.float64
+    return numpy.array([null_value if v is None else v for v in values], dtype=dtype)
+
+
+class SourceTable(object):
+    """
+    A column oriented table of sources of a single type, such as models.Road.  Every field except the
+    geometry is held as a typed NumPy column, with missing values replaced by -999.  Geometries are packed
+    into a single (n, 2) array of lng/lat vertices, with offsets marking where each source's vertices
+    start and end.
+    """
+
+    def __init__(self, type_, columns, coordinates, offsets):
+        self.type_ = type_
+        self.fields = type_.fields
+        self.columns = columns
+        self.coordinates = coordinates
+        self.offsets = offsets
+        self._projected = None
+
+    @classmethod
+    def from_rows(cls, type_, rows):
+        """
+        Builds a table from rows laid out like type_.fields, which is how sources are stored in a
+        scenario's JSON columns.
+        """
+        rows = list(rows)
+        columns = {}
+        geometries = []
+        point_geometry = False
+        for (i, field) in enumerate(type_.fields):
+            kind = _column_kind(type_, field)
+            values = [row[i] for row in rows]
+            if kind == "geom":
+                geometries = values
+                point_geometry = getattr(type_, field).property.columns[0].type.geometry_type == "POINT"
+                continue
+            if field in _name_fields:
+                values = [_clean_name(v) for v in values]
+            columns[field] = _to_column(kind, values)
+        if point_geometry:
+            coordinates = numpy.array(geometries, dtype=numpy.float64).reshape(-1, 2)
+            offsets = numpy.arange(len(rows) + 1)
+        else:
+            vertex_counts = [len(g) for g in geometries]
+            coordinates = numpy.array([v for g in geometries for v in g], dtype=numpy.float64).reshape(-1, 2)
+            offsets = numpy.concatenate(([0], numpy.cumsum(vertex_counts, dtype=numpy.int64)))
+        return cls(type_, columns, coordinates, offsets)
+
+    @classmethod
+    def from_database(cls, type_, bounds, connection=None, batch_size=None):
+        """
+        Loads the sources of type_ whose geometry intersects bounds, (min_lng, min_lat, max_lng, max_lat),
+        straight from its table.  The spatial index picks the rows, which are streamed through a server
+        side cursor settings.source_batch_size at a time with their geometries as WKB, so no ORM objects
+        or shapes are ever built.  Fields that are not columns, such as the road emission multipliers,
+        are 1.
+        """
+        from ctools_backend import models
+        geometry_column = type_.geom.property.columns[0]
+        srid = geometry_column.type.srid if geometry_column.type.srid > 0 else settings.source_srid
+        fields = [f for f in type_.fields if f != "geom" and _mapped_columns(type_, f)]
+        select = sa.select([_mapped_columns(type_, f)[0] for f in fields] +
+                           [sa.func.ST_AsBinary(geometry_column, "NDR")]).where(
+            sa.func.ST_Intersects(geometry_column, sa.func.ST_MakeEnvelope(*(list(bounds) + [srid]))))
+        values = [[] for _ in fields]
+        coordinates = []
+        offsets = [numpy.zeros(1, dtype=numpy.int64)]
+        count = 0
+        close = connection is None
+        connection = connection or models.get_engine().connect()
+        try:
+            result = connection.execution_options(stream_results=True).execute(select)
+            while True:
+                rows = result.fetchmany(batch_size or settings.source_batch_size)
+                if not rows:
+                    break
+                batch = list(zip(*rows))
+                for (column, batch_values) in zip(values, batch):
+                    column.extend(batch_values)
+                (batch_coordinates, batch_offsets) = geo.wkb_to_coordinates(batch[-1])
+                coordinates.append(batch_coordinates)
+                offsets.append(batch_offsets[1:] + count)
+                count += len(batch_coordinates)
+        finally:
+            if close:
+                connection.close()
+        columns = {}
+        for (field, field_values) in zip(fields, values):
+            if field in _name_fields:
+                field_values = [_clean_name(v) for v in field_values]
+            columns[field] = _to_column(_column_kind(type_, field), field_values)
+        offsets = numpy.concatenate(offsets)
+        for field in type_.fields:
+            if field != "geom" and field not in columns:
+                columns[field] = numpy.ones(len(offsets) - 1)
+        coordinates = numpy.concatenate(coordinates) if coordinates else numpy.empty((0, 2))
+        return cls(type_, columns, coordinates, offsets)
+
+    def rows(self):
+        """
+        Returns the sources as rows laid out like type_.fields, as a scenario's JSON columns store them.
+        """
+        point_geometry = getattr(self.type_, "geom").property.columns[0].type.geometry_type == "POINT"
+        columns = []
+        for field in self.fields:
+            if field != "geom":
+                columns.append(self.columns[field].tolist())
+            elif point_geometry:
+                columns.append(self.coordinates.tolist())
+            else:
+                columns.append([self.geometry(i).tolist() for i in range(len(self))])
+        return [list(row) for row in zip(*columns)]
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, field):
+        return self.columns[field]
+
+    @property
+    def vertex_counts(self):
+        return numpy.diff(self.offsets)
+
+    @property
+    def projected_coordinates(self):
+        """
+        The Lambert conformal conic x and y arrays of every vertex, projected once and then reused.
+        """
+        if self._projected is None:
+            self._projected = geo.mercator_to_lcc_array(self.coordinates[:, 0], self.coordinates[:, 1])
+        return self._projected
+
+    def geometry(self, i):
+        return self.coordinates[self.offsets[i]:self.offsets[i + 1]]
+
+    def vertex_rows(self):
+        """
+        Returns the source row that each vertex belongs to.
+        """
+        return numpy.repeat(numpy.arange(len(self)), self.vertex_counts)
+
+    def take(self, rows):
+        """
+        Returns a new table holding the given rows, in the given order.
+        """
+        rows = numpy.asarray(rows, dtype=numpy.int64)
+        counts = self.vertex_counts[rows]
+        starts = self.offsets[rows]
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts, dtype=numpy.int64)))
+        vertices = numpy.repeat(starts - offsets[:-1], counts) + numpy.arange(offsets[-1])
+        columns = {field: column[rows] for (field, column) in self.columns.items()}
+        return SourceTable(self.type_, columns, self.coordinates[vertices], offsets)
+
+    def segments(self):
+        """
+        Splits every line into its straight segments, one row per pair of consecutive vertices.  The
+        segments share this table's projected vertices rather than projecting them again.
+        """
+        (xs, ys) = self.projected_coordinates
+        segment_counts = numpy.maximum(self.vertex_counts - 1, 0)
+        rows = numpy.repeat(numpy.arange(len(self)), segment_counts)
+        segment_offsets = numpy.cumsum(segment_counts) - segment_counts
+        first_vertex = self.offsets[rows] + numpy.arange(len(rows)) - numpy.repeat(segment_offsets, segment_counts)
+        vertices = numpy.column_stack((first_vertex, first_vertex + 1)).ravel()
+        columns = {field: column[rows] for (field, column) in self.columns.items()}
+        segments = SourceTable(self.type_, columns, self.coordinates[vertices],
+                               numpy.arange(0, 2 * len(rows) + 1, 2))
+        segments._projected = (xs[vertices], ys[vertices])
+        return segments
+
+
+def _row_format(columns):
+    formats = []
+    for column in columns:
+        if column.dtype.kind in "iu":
+            formats.append("%d")
+        elif column.dtype.kind == "f":
+            formats.append("%.12g")
+        else:
+            formats.append("%s")
+    return ",".join(formats) + "\r\n"
+
+
+def write_csv(file_name, headers, columns, chunk_rows=16384):
+    """
+    Writes NumPy columns to a CSV file a chunk of rows at a time, so that only one chunk is ever rendered
+    in memory.  Integer columns are written as integers, float columns with a fixed %.12g format, and
+    anything else as text.
+    """
+    columns = [numpy.asarray(column) for column in columns]
+    row_format = _row_format(columns)
+    row_count = len(columns[0]) if columns else 0
+    with open(file_name, "w", 1 << 20) as f:
+        f.write(",".join(headers) + "\r\n")
+        for start in range(0, row_count, chunk_rows):
+            chunk = [column[start:start + chunk_rows].tolist() for column in columns]
+            f.write("".join([row_format % row for row in zip(*chunk)]))
+
+
+def _parse_chunk(chunk, column_count):
+    # Treating line breaks as separators lets NumPy parse the whole chunk in one pass
+    values = numpy.fromstring(chunk.replace("\n", ","), dtype=numpy.float64, sep=",")
+    if values.size % column_count or values.size // column_count != chunk.count("\n"):
+        # Blank lines or unparseable values; fall back to the slower line by line reader
+        values = numpy.loadtxt(chunk.splitlines(), dtype=numpy.float64, delimiter=",", ndmin=2)
+    return values.reshape(-1, column_count)
+
+
+def read_csv_columns(file_name, columns, chunk_bytes=1 << 22):
+    """
+    Reads the given numeric columns (by position) of a CSV file with a header row, parsing the file a
+    chunk of lines at a time.  Returns one float64 array per requested column.
+    """
+    results = [[] for _ in columns]
+    with open(file_name, "rb") as f:
+        column_count = len(f.readline().split(","))
+        while True:
+            chunk = f.read(chunk_bytes)
+            if not chunk:
+                break
+            chunk += f.readline()
+            if not chunk.endswith("\n"):
+                chunk += "\n"
+            values = _parse_chunk(chunk, column_count)
+            for (result, column) in zip(results, columns):
+                result.append(values[:, column].copy())
+    return [numpy.concatenate(result) if result else numpy.empty(0) for result in results]
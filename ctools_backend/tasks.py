@@ -2,17 +2,22 @@ import argparse
 import os
 import numpy as np
 
-import tablib
+from ctools_backend import metrics, models, tables
+from wrappers import CTools, CToolsComparison, CToolsEnsemble
 
-from ctools_backend import models, raster
-from wrappers import CTools
+# Every value each ensemble option can take, used when an ensemble asks for "all" of them
+ensemble_options = {
+    "pollutants": [str(p) for p in range(1, 12)],
+    "met_conditions": range(1, 6),
+    "seasons": [1, 2],
+    "days": [1, 2],
+    "hours": range(1, 5)
+}
 
 
 def create_results_file(concentrations, log_dir, header="concentration"):
-    ds = tablib.Dataset(*concentrations, headers=["x", "y", header])
     target_dir = os.path.join(os.path.dirname(os.path.realpath(__file__)), log_dir, "results.csv")
-    with open(target_dir, 'w') as f:
-        f.write(ds.csv)
+    tables.write_csv(target_dir, ["x", "y", header], [concentrations[:, 0], concentrations[:, 1], concentrations[:, 2]])
 
 
 def transform_comparison_data(datum):
@@ -22,7 +27,7 @@ def transform_comparison_data(datum):
     return np.sign(datum) * np.log10(abs_val)
 
 
-def ctools(pollutant, model_type, scenario_id, user_id=None, tool='CPORT'):
+def ctools(pollutant, model_type, scenario_id, user_id=None, tool='CPORT', output_mode=None, receptor_mode=None):
     session = models.Session()
     scenario = session.query(models.Scenario).filter(models.Scenario.scenario_id == scenario_id).first()
     if not user_id:
@@ -31,17 +36,72 @@ def ctools(pollutant, model_type, scenario_id, user_id=None, tool='CPORT'):
                                       scenario=scenario, user_id=user_id, tool=tool)
     session.add(scenario_run)
     session.commit()
-    cline_ = CTools(scenario=scenario, scenario_run=scenario_run)
-    concentrations = cline_.calculate_concentrations()
-    concentrations[:, 2] = np.log10(concentrations[:, 2])
-    raster_generator = raster.RasterGenerator(scenario_run=scenario_run)
-    raster_generator.create_pollution_raster(concentrations)
-    scenario_run.finalize_run()
+    run_metrics = metrics.RunMetrics("ctools")
+    with metrics.collect(run_metrics):
+        cline_ = CTools(scenario=scenario, scenario_run=scenario_run, receptor_mode=receptor_mode)
+        concentrations = cline_.calculate_concentrations()
+        concentrations[:, 2] = np.log10(concentrations[:, 2])
+        # raster pulls in matplotlib and SciPy, so it is only imported once there is something to render
+        from ctools_backend import raster
+        raster_generator = raster.RasterGenerator(scenario_run=scenario_run)
+        raster_generator.create_pollution_raster(concentrations, output_mode)
+        scenario_run.finalize_run()
+    scenario_run.metrics = run_metrics.to_dict()
     session.commit()
     return scenario_run
 
 
-def ctools_comparison(pollutant, model_type, comparison_type, scenario_id_1, scenario_id_2, user_id=None, tool='CPORT'):
+def ctools_ensemble(pollutants, model_type, scenario_id, met_conditions=None, seasons=None, days=None, hours=None,
+                    user_id=None, tool='CPORT'):
+    """
+    Runs a scenario for every combination of the given pollutants, met conditions, seasons, days and hours
+    (None keeps the scenario's own value).  Each member's results are written to results.csv in its
+    directory under members/, and the minimum, mean and maximum over the members of each pollutant to
+    statistics_<pollutant>.csv in the run's output directory.
+    """
+    session = models.Session()
+    scenario = session.query(models.Scenario).filter(models.Scenario.scenario_id == scenario_id).first()
+    if not user_id:
+        user_id = scenario.user_id
+    scenario_run = models.ScenarioRun(status="pending", pollutant=",".join(pollutants), model_type=model_type,
+                                      scenario=scenario, user_id=user_id, tool=tool)
+    session.add(scenario_run)
+    session.commit()
+    run_metrics = metrics.RunMetrics("ctools_ensemble")
+    with metrics.collect(run_metrics):
+        ensemble = CToolsEnsemble(scenario, scenario_run, pollutants, met_conditions=met_conditions,
+                                  seasons=seasons, days=days, hours=hours)
+        results = ensemble.calculate_concentrations()
+        with metrics.phase("outputs"):
+            by_pollutant = {}
+            for (member, concentrations) in zip(ensemble.members, results):
+                tables.write_csv(os.path.join(member.output_directory, "results.csv"), ["x", "y", "concentration"],
+                                 [concentrations[:, 0], concentrations[:, 1], concentrations[:, 2]])
+                by_pollutant.setdefault(member.options["pollutant"], []).append(concentrations[:, 2])
+            receptors = ensemble.base.receptors
+            for (pollutant, members) in by_pollutant.items():
+                members = np.vstack(members)
+                tables.write_csv(os.path.join(scenario_run.output_directory, "statistics_%s.csv" % pollutant),
+                                 ["x", "y", "min", "mean", "max"], [receptors.x, receptors.y, members.min(axis=0),
+                                                                    members.mean(axis=0), members.max(axis=0)])
+        scenario_run.finalize_run()
+    scenario_run.metrics = run_metrics.to_dict()
+    session.commit()
+    return scenario_run
+
+
+def _ensemble_values(value, option):
+    if value is None:
+        return None
+    if value == "all":
+        return ensemble_options[option]
+    if option == "pollutants":
+        return value.split(",")
+    return [int(v) for v in value.split(",")]
+
+
+def ctools_comparison(pollutant, model_type, comparison_type, scenario_id_1, scenario_id_2, user_id=None, tool='CPORT',
+                      output_mode=None):
     session = models.Session()
     scenario_1 = session.query(models.Scenario).filter(models.Scenario.scenario_id == scenario_id_1).first()
     scenario_2 = session.query(models.Scenario).filter(models.Scenario.scenario_id == scenario_id_2).first()
@@ -52,21 +112,24 @@ def ctools_comparison(pollutant, model_type, comparison_type, scenario_id_1, sce
                                                 tool=tool, comparison_mode=comparison_type)
     session.add(scenario_run)
     session.commit()
-    cline_1 = CTools(scenario=scenario_1, scenario_run=scenario_run, output_directory=scenario_run.output_directory_1)
-    cline_2 = CTools(scenario=scenario_2, scenario_run=scenario_run, output_directory=scenario_run.output_directory_2)
-    concentrations = cline_1.calculate_concentrations()
-    concentrations_2 = cline_2.calculate_concentrations()
-    raster_generator = raster.RasterGenerator(scenario_run=scenario_run)
-    if comparison_type == "1":
-        title = "concentration difference"
-        concentrations[:, 2] = [transform_comparison_data(d) for d in
-                                (concentrations[:, 2] - concentrations_2[:, 2])]
-    else:
-        title = "concentration difference (%)"
-        concentrations[:, 2] = (concentrations[:, 2] - concentrations_2[:, 2]) / concentrations_2[:, 2] * 100
-    raster_generator.create_pollution_raster(concentrations)
-    create_results_file(concentrations, scenario_run.temp_dir, title)
-    scenario_run.finalize_run()
+    run_metrics = metrics.RunMetrics("ctools_comparison")
+    with metrics.collect(run_metrics):
+        comparison = CToolsComparison(scenario_1, scenario_2, scenario_run)
+        (concentrations, concentrations_2) = comparison.calculate_concentrations()
+        from ctools_backend import raster
+        raster_generator = raster.RasterGenerator(scenario_run=scenario_run)
+        if comparison_type == "1":
+            title = "concentration difference"
+            concentrations[:, 2] = [transform_comparison_data(d) for d in
+                                    (concentrations[:, 2] - concentrations_2[:, 2])]
+        else:
+            title = "concentration difference (%)"
+            concentrations[:, 2] = (concentrations[:, 2] - concentrations_2[:, 2]) / concentrations_2[:, 2] * 100
+        raster_generator.create_pollution_raster(concentrations, output_mode)
+        with metrics.phase("outputs"):
+            create_results_file(concentrations, scenario_run.temp_dir, title)
+        scenario_run.finalize_run()
+    scenario_run.metrics = run_metrics.to_dict()
     session.commit()
     return scenario_run
 
@@ -99,12 +162,28 @@ def main():
     """, default="1")
     parser.add_argument("-u", "--user", help="The user-id to associate with this scenario run")
     parser.add_argument("--tool", help="The tool this scenario run should be associated with", default="CPORT")
+    parser.add_argument("-e", "--ensemble", action="store_true", help="""Run an ensemble over every combination
+    of the comma separated pollutants and met conditions, seasons, days and hours given (or "all" of them)""")
+    parser.add_argument("--met_conditions", help="Ensemble met conditions, e.g. 1,3,5 or all")
+    parser.add_argument("--seasons", help="Ensemble seasons, e.g. 1,2 or all")
+    parser.add_argument("--days", help="Ensemble days, e.g. 1,2 or all")
+    parser.add_argument("--hours", help="Ensemble hours, e.g. 1,4 or all")
+    parser.add_argument("--tiles", dest="output_mode", action="store_const", const="tiles",
+                        help="Render the results as map tiles served by tiles.py rather than a single image")
+    parser.add_argument("--adaptive", dest="receptor_mode", action="store_const", const="adaptive",
+                        help="Place receptors where concentrations change fastest rather than on a fixed grid")
     args = parser.parse_args()
-    if args.compare_with:
+    if args.ensemble:
+        ctools_ensemble(_ensemble_values(args.pollutant, "pollutants"), args.model_type, args.scenario,
+                        met_conditions=_ensemble_values(args.met_conditions, "met_conditions"),
+                        seasons=_ensemble_values(args.seasons, "seasons"), days=_ensemble_values(args.days, "days"),
+                        hours=_ensemble_values(args.hours, "hours"), user_id=args.user, tool=args.tool)
+    elif args.compare_with:
         ctools_comparison(args.pollutant, args.model_type, args.comparison_mode, args.scenario, args.compare_with,
-                          user_id=args.user, tool=args.tool)
+                          user_id=args.user, tool=args.tool, output_mode=args.output_mode)
     else:
-        ctools(args.pollutant, args.model_type, args.scenario, user_id=args.user, tool=args.tool)
+        ctools(args.pollutant, args.model_type, args.scenario, user_id=args.user, tool=args.tool,
+               output_mode=args.output_mode, receptor_mode=args.receptor_mode)
 
 if __name__ == "__main__":
     main()
@@ -1,6 +1,9 @@
 import json
+import os
+import resource
+import tarfile
 
-from ctools_backend import models
+from ctools_backend import messaging, models, settings, tables, worker
 import tasks
 
 lat_min = 32.6191597574
@@ -36,6 +39,18 @@ def add_scenarios_from_json(scenario_file):
     session.add(scenario_2)
     session.commit()
 
+def add_scenario_from_tables(name="Test bounds"):
+    # Every source in the test bounds, streamed straight from the source tables
+    bounds = (lon_min, lat_min, lon_max, lat_max)
+    sources = {}
+    for (attribute, include, type_) in models.Scenario.source_lists:
+        sources[attribute] = tables.SourceTable.from_database(type_, bounds).rows()
+        sources[include] = True
+    scenario = models.Scenario(name=name, hour=1, season=1, day=1, zoom=12, met_conditions=1, **sources)
+    session = models.Session()
+    session.add(scenario)
+    session.commit()
+
 def run_ctools_single_scenario():
     session = models.Session()
     scenario = session.query(models.Scenario).first()
@@ -46,6 +61,37 @@ def run_ctools_comparison_scenario():
     s = session.query(models.Scenario).all()
     tasks.ctools_comparison("1", "1", "Relative", s[0].scenario_id, s[1].scenario_id)
 
+def run_ctools_comparison_scenario_as_tiles():
+    # Tiles mode writes a tile surface in place of concentrations.png, which the archive must take instead
+    session = models.Session()
+    s = session.query(models.Scenario).all()
+    scenario_run = tasks.ctools_comparison("1", "1", "Relative", s[0].scenario_id, s[1].scenario_id,
+                                           output_mode="tiles")
+    assert scenario_run.status == "completed"
+    with tarfile.open(os.path.join(settings.output_tar_directory, scenario_run.results_file_name)) as tar:
+        names = tar.getnames()
+    assert "./tiles/tiles.json" in names and "./concentrations.png" not in names
+
+def run_ctools_ensemble_sweep():
+    # More members than the process may open files, with the result cache holding a lock file open per key it locks
+    resource.setrlimit(resource.RLIMIT_NOFILE, (1024, resource.getrlimit(resource.RLIMIT_NOFILE)[1]))
+    session = models.Session()
+    scenario = session.query(models.Scenario).first()
+    options = tasks.ensemble_options
+    scenario_run = tasks.ctools_ensemble(options["pollutants"], "1", scenario.scenario_id,
+                                         met_conditions=options["met_conditions"], seasons=options["seasons"],
+                                         days=options["days"], hours=range(1, 6))
+    assert scenario_run.status == "completed"
+    assert len(os.listdir(os.path.join(scenario_run.output_directory, "members"))) >= 1024
+
+def run_ctools_single_scenario_on_worker():
+    # The in-memory transport stands in for the broker; the worker stops once it has run the job
+    session = models.Session()
+    scenario = session.query(models.Scenario).first()
+    with messaging.connect("memory://") as connection:
+        messaging.publish_job("ctools", ["1", "1", scenario.scenario_id], connection=connection)
+        worker.Worker(connection, processes=1, max_jobs=1).run()
+
 if __name__ == "__main__":
     # add_scenarios_from_json("two_scenario_data.json")
     add_scenarios_from_json("two_scenario_cport_data.json")
@@ -0,0 +1,211 @@
+import argparse
+import errno
+import json
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+from ctools_backend import interpolation, rendering
+import settings
+
+tile_size = 256
+
+_surface_cache_size = 16
+_surfaces = OrderedDict()
+_surfaces_lock = threading.Lock()
+
+
+def lng_lat_to_pixel(lng, lat, zoom):
+    """
+    Converts longitudes and latitudes to global web mercator pixel coordinates at a zoom level.
+    """
+    scale = float(tile_size * 2 ** zoom)
+    lat = np.radians(np.clip(lat, -85.0511, 85.0511))
+    x = (np.asarray(lng) + 180.0) / 360.0 * scale
+    y = (1 - np.log(np.tan(lat) + 1 / np.cos(lat)) / math.pi) / 2 * scale
+    return x, y
+
+
+def pixel_to_lng_lat(x, y, zoom):
+    scale = float(tile_size * 2 ** zoom)
+    lng = np.asarray(x) / scale * 360.0 - 180.0
+    lat = np.degrees(np.arctan(np.sinh(math.pi * (1 - 2 * np.asarray(y) / scale))))
+    return lng, lat
+
+
+def _write_atomically(file_name, write):
+    try:
+        os.makedirs(os.path.dirname(file_name))
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    temporary_file = "%s.%d.%d.tmp" % (file_name, os.getpid(), threading.current_thread().ident)
+    with open(temporary_file, "wb") as f:
+        write(f)
+    os.rename(temporary_file, file_name)
+
+
+class TileSurface(object):
+    """
+    A concentration surface rendered as an XYZ (web mercator) tile pyramid.  The receptor values are saved
+    with the run, and each tile is rendered the first time it is asked for and then kept on disk.  Tiles at
+    the native zoom, where the run spans about settings.tile_native_pixels, and the more detailed levels
+    above it are interpolated from the receptors; the overview levels below are downsampled from the
+    level above them, so zooming out never interpolates again.
+    """
+    surface_file = "surface.npz"
+
+    def __init__(self, directory):
+        self.directory = directory
+        with np.load(os.path.join(directory, self.surface_file)) as surface:
+            self.lng = surface["lng"]
+            self.lat = surface["lat"]
+            self.values = surface["values"]
+            (self.vmin, self.vmax) = surface["value_range"]
+            self.diverging = bool(surface["diverging"])
+        self.bounds = (self.lng.min(), self.lat.min(), self.lng.max(), self.lat.max())
+        (self.native_zoom, self.max_zoom) = self.zoom_range(self.bounds)
+
+    @staticmethod
+    def zoom_range(bounds):
+        (west, south, east, north) = bounds
+        native_zoom = 0
+        while native_zoom < 22:
+            (x, y) = lng_lat_to_pixel([west, east], [north, south], native_zoom)
+            if max(x[1] - x[0], y[1] - y[0]) >= settings.tile_native_pixels:
+                break
+            native_zoom += 1
+        return native_zoom, native_zoom + settings.tile_detail_levels
+
+    @classmethod
+    def create(cls, directory, lng, lat, values, value_range, diverging=False):
+        """
+        Saves a surface of receptor values for tile rendering, along with a TileJSON style description of
+        it for clients, and returns it.
+        """
+        def write_surface(f):
+            np.savez(f, lng=lng, lat=lat, values=values, value_range=np.asarray(value_range, dtype=np.float64),
+                     diverging=diverging)
+        _write_atomically(os.path.join(directory, cls.surface_file), write_surface)
+        surface = cls(directory)
+        description = {
+            "tilejson": "2.2.0",
+            "tiles": ["{z}/{x}/{y}.png"],
+            "minzoom": 0,
+            "maxzoom": surface.max_zoom,
+            "bounds": [float(b) for b in surface.bounds],
+            "value_range": [float(v) for v in value_range]
+        }
+        _write_atomically(os.path.join(directory, "tiles.json"), lambda f: f.write(json.dumps(description)))
+        return surface
+
+    @classmethod
+    def open(cls, directory):
+        """
+        Returns the surface saved in a directory, reusing surfaces opened recently.
+        """
+        with _surfaces_lock:
+            surface = _surfaces.pop(directory, None)
+            if surface is None:
+                surface = cls(directory)
+            _surfaces[directory] = surface
+            while len(_surfaces) > _surface_cache_size:
+                _surfaces.popitem(last=False)
+        return surface
+
+    def _intersects(self, zoom, x, y):
+        (west, north) = pixel_to_lng_lat(x * tile_size, y * tile_size, zoom)
+        (east, south) = pixel_to_lng_lat((x + 1) * tile_size, (y + 1) * tile_size, zoom)
+        return west <= self.bounds[2] and east >= self.bounds[0] and south <= self.bounds[3] and north >= self.bounds[1]
+
+    def _interpolate(self, zoom, x, y):
+        pixels = np.arange(tile_size) + 0.5
+        (lng, _) = pixel_to_lng_lat(x * tile_size + pixels, 0, zoom)
+        (_, lat) = pixel_to_lng_lat(0, y * tile_size + pixels, zoom)
+        (grid_lng, grid_lat) = np.meshgrid(lng, lat)
+        interpolator = interpolation.ReceptorInterpolator.for_receptors(self.lng, self.lat)
+        values = interpolator.interpolate(self.values, grid_lng, grid_lat, fill_value=np.nan)
+        return values.reshape(tile_size, tile_size)
+
+    def _downsample(self, zoom, x, y):
+        children = np.empty((2 * tile_size, 2 * tile_size))
+        for (row, column) in ((0, 0), (0, 1), (1, 0), (1, 1)):
+            children[row * tile_size:(row + 1) * tile_size, column * tile_size:(column + 1) * tile_size] = \
+                self.tile_values(zoom + 1, 2 * x + column, 2 * y + row)
+        # Each pixel averages the 2x2 pixels it covers one level up, ignoring those outside the surface
+        blocks = children.reshape(tile_size, 2, tile_size, 2)
+        counts = (~np.isnan(blocks)).sum(axis=(1, 3))
+        with np.errstate(invalid="ignore"):
+            return np.nansum(blocks, axis=(1, 3)) / np.where(counts, counts, np.nan)
+
+    def tile_values(self, zoom, x, y):
+        """
+        Returns the 256x256 values of a tile, with NaN where it is off the surface.
+        """
+        if not self._intersects(zoom, x, y):
+            values = np.empty((tile_size, tile_size))
+            values.fill(np.nan)
+            return values
+        values_file = os.path.join(self.directory, str(zoom), str(x), "%d.npy" % y)
+        if os.path.exists(values_file):
+            return np.load(values_file)
+        if zoom >= self.native_zoom:
+            values = self._interpolate(zoom, x, y)
+        else:
+            values = self._downsample(zoom, x, y)
+        _write_atomically(values_file, lambda f: np.save(f, values))
+        return values
+
+    def tile(self, zoom, x, y):
+        """
+        Returns the file name of a tile's PNG, rendering it first if it has not been yet.  Returns None for
+        tiles beyond the surface's zoom range.
+        """
+        if not 0 <= zoom <= self.max_zoom or not (0 <= x < 2 ** zoom and 0 <= y < 2 ** zoom):
+            return None
+        tile_file = os.path.join(self.directory, str(zoom), str(x), "%d.png" % y)
+        if not os.path.exists(tile_file):
+            rgba = rendering.colorize(self.tile_values(zoom, x, y), self.vmin, self.vmax, self.diverging)
+            _write_atomically(tile_file, lambda f: f.write(rendering.encode_png(rgba)))
+        return tile_file
+
+
+_tile_path = re.compile(r"^/([\w-]+)/(\d+)/(\d+)/(\d+)\.png$")
+
+
+def application(environ, start_response):
+    """
+    A WSGI application serving /<scenario run directory>/<z>/<x>/<y>.png from the tile surfaces saved in
+    settings.scenario_run_directory, rendering tiles as they are first requested.
+    """
+    match = _tile_path.match(environ.get("PATH_INFO", ""))
+    directory = match and os.path.join(settings.scenario_run_directory, match.group(1), "tiles")
+    if not match or not os.path.exists(os.path.join(directory, TileSurface.surface_file)):
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return ["Not found"]
+    (zoom, x, y) = [int(g) for g in match.groups()[1:]]
+    tile_file = TileSurface.open(directory).tile(zoom, x, y)
+    if tile_file is None:
+        start_response("404 Not Found", [("Content-Type", "text/plain")])
+        return ["Not found"]
+    with open(tile_file, "rb") as f:
+        body = f.read()
+    start_response("200 OK", [("Content-Type", "image/png"), ("Content-Length", str(len(body))),
+                              ("Cache-Control", "public, max-age=86400")])
+    return [body]
+
+
+def main():
+    from wsgiref.simple_server import make_server
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="localhost", help="The address to serve tiles on")
+    parser.add_argument("-p", "--port", type=int, default=8080, help="The port to serve tiles on")
+    args = parser.parse_args()
+    make_server(args.host, args.port, application).serve_forever()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,241 @@
+import Queue
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import traceback
+from multiprocessing.pool import ThreadPool
+
+from kombu.mixins import ConsumerMixin
+
+from ctools_backend import messaging
+import settings
+
+logger = logging.getLogger(__name__)
+
+# The functions in tasks.py that jobs may call
+job_tasks = ("ctools", "ctools_comparison", "ctools_ensemble")
+
+# In job processes, the queue each job's id and process id are put on as it starts (see Worker._find_lost_jobs)
+_started_jobs = None
+
+
+def _prewarm():
+    # Imported once in the worker before the pool forks, so that every job process starts with matplotlib,
+    # SciPy, SQLAlchemy, pyproj and the models already loaded
+    import matplotlib
+    matplotlib.use("Agg")
+    from matplotlib import pyplot
+    from scipy import spatial
+    from ctools_backend import geo, interpolation, models, raster, tasks, wrappers
+
+
+def _init_job_process(started_jobs=None):
+    global _started_jobs
+    _started_jobs = started_jobs
+    # Interrupts are for the worker to handle; jobs in progress are left to finish
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    from ctools_backend import models
+    # Connections must not be shared with the parent, so the pool is dropped and one connection opened afresh
+    models.get_engine().dispose()
+    try:
+        models.get_engine().connect().close()
+    except Exception:
+        logger.exception("Could not connect to the database while starting a job process")
+
+
+def _run_job(body, job_id=None):
+    """
+    Runs a job in a pool process.  Returns ("completed", scenario_run_id) or ("failed", traceback), so that
+    failures reach the worker rather than being lost in the pool.
+    """
+    from ctools_backend import models, tasks
+    if _started_jobs is not None:
+        _started_jobs.put((job_id, os.getpid()))
+    try:
+        if body["task"] not in job_tasks:
+            raise ValueError("Unknown task %r" % body["task"])
+        scenario_run = getattr(tasks, body["task"])(*body.get("args", []), **body.get("kwargs", {}))
+        return "completed", scenario_run.scenario_run_id
+    # SystemExit would otherwise end the pool process, and the job with it, without a result
+    except (Exception, SystemExit):
+        return "failed", traceback.format_exc()
+    finally:
+        models.Session.remove()
+
+
+def run_many(bodies, threads=None):
+    """
+    Runs jobs, given as message bodies, on a pool of threads in this process, where they share its imports,
+    caches and database connection pool, and its limit on model runs at once.  Returns each job's result
+    (see _run_job) in the order given.
+    """
+    pool = ThreadPool(threads or settings.worker_processes)
+    try:
+        return pool.map(_run_job, bodies, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class Worker(ConsumerMixin):
+    """
+    Consumes scenario run jobs from messaging.job_queue and runs them in a pool of prewarmed processes.
+    At most prefetch jobs are taken off the queue at a time, and each is only acknowledged once it has
+    run, so jobs held by a worker that dies are redelivered to another.  Failed jobs are rejected rather
+    than requeued.  A job whose pool process dies under it (killed for running out of memory, say) is
+    requeued, unless it had already been redelivered, in which case it is rejected too.  stop() stops
+    taking jobs and lets the ones in progress finish; jobs taken off the queue but not yet started are
+    requeued.  A worker given max_jobs stops after starting that many.  With threads, jobs run on threads
+    of the worker process rather than in processes of their own.
+    """
+
+    def __init__(self, connection, processes=None, prefetch=None, max_jobs=None, threads=False):
+        self.connection = connection
+        self.processes = processes or settings.worker_processes
+        self.threads = threads
+        self.prefetch = prefetch or settings.worker_prefetch or self.processes
+        self.max_jobs = max_jobs
+        self.jobs_started = 0
+        self.stopping = False
+        self._pool = None
+        self._consumers = []
+        # The message of each job in progress, and the process running it once it has started, by job id
+        self._jobs = {}
+        self._finished = Queue.Queue()
+        self._started_jobs = None
+        self._lost_jobs = False
+
+    def get_consumers(self, Consumer, channel):
+        self._consumers = [Consumer(queues=[messaging.job_queue], callbacks=[self._on_message], accept=["json"],
+                                    prefetch_count=self.prefetch)]
+        return self._consumers
+
+    def _on_message(self, body, message):
+        if self.stopping:
+            message.requeue()
+            return
+        self.jobs_started += 1
+        job_id = self.jobs_started
+        self._jobs[job_id] = [message, None]
+        # Pool callbacks run on the pool's result thread; acknowledging is left to the consuming thread
+        self._pool.apply_async(_run_job, (body, job_id), callback=lambda result: self._finished.put((job_id, result)))
+        if self.max_jobs and self.jobs_started >= self.max_jobs:
+            self.stop()
+
+    def _settle(self, message, result):
+        (status, detail) = result
+        try:
+            if status == "completed":
+                logger.info("Completed scenario run %s", detail)
+                message.ack()
+            else:
+                logger.error("Job %r failed:\n%s", message.payload, detail)
+                message.reject()
+        except Exception:
+            logger.exception("Could not settle job %r; it will be redelivered", message.payload)
+
+    def _find_lost_jobs(self):
+        """
+        Settles the jobs whose pool process has died.  The pool replaces the process, but never completes its
+        job, so the job is noticed by its process id no longer being among the pool's.
+        """
+        while True:
+            try:
+                (job_id, pid) = self._started_jobs.get_nowait()
+            except Queue.Empty:
+                break
+            if job_id in self._jobs:
+                self._jobs[job_id][1] = pid
+        alive = set(process.pid for process in list(self._pool._pool) if process.is_alive())
+        for (job_id, (message, pid)) in self._jobs.items():
+            if pid is None or pid in alive:
+                continue
+            del self._jobs[job_id]
+            self._lost_jobs = True
+            try:
+                if message.delivery_info.get("redelivered"):
+                    logger.error("Job %r was lost again when its process died; rejecting it", message.payload)
+                    message.reject()
+                else:
+                    logger.error("Job %r was lost when its process died; requeueing it", message.payload)
+                    message.requeue()
+            except Exception:
+                logger.exception("Could not settle lost job %r; it will be redelivered", message.payload)
+
+    def on_iteration(self):
+        while True:
+            try:
+                (job_id, result) = self._finished.get_nowait()
+            except Queue.Empty:
+                break
+            # Jobs given up for lost have already been settled
+            if job_id in self._jobs:
+                self._settle(self._jobs.pop(job_id)[0], result)
+        if self._started_jobs is not None:
+            self._find_lost_jobs()
+        if self.stopping:
+            for consumer in self._consumers:
+                consumer.cancel()
+            self._consumers = []
+            if not self._jobs:
+                self.should_stop = True
+
+    def stop(self):
+        """
+        Stops taking jobs and lets the ones in progress finish.  Safe to call from a signal handler.
+        """
+        self.stopping = True
+
+    def run(self, *args, **kwargs):
+        if self.threads:
+            self._pool = ThreadPool(self.processes)
+        else:
+            # The pool forks before the connection is opened, so job processes never share its socket
+            self._started_jobs = multiprocessing.Queue()
+            self._pool = multiprocessing.Pool(self.processes, initializer=_init_job_process,
+                                              initargs=(self._started_jobs,))
+        finished = False
+        try:
+            super(Worker, self).run(*args, **kwargs)
+            finished = True
+        finally:
+            # A pool with lost jobs would wait for them forever on closing
+            if finished and not self._lost_jobs:
+                self._pool.close()
+            else:
+                self._pool.terminate()
+            self._pool.join()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-b", "--broker", help="The broker URL to consume jobs from", default=settings.broker_url)
+    parser.add_argument("-p", "--processes", type=int, help="How many jobs to run at once",
+                        default=settings.worker_processes)
+    parser.add_argument("--prefetch", type=int, help="How many jobs to take off the queue at a time",
+                        default=settings.worker_prefetch)
+    parser.add_argument("--max_jobs", type=int, help="Stop after starting this many jobs")
+    parser.add_argument("--threads", action="store_true",
+                        help="Run jobs on threads of the worker rather than in processes of their own")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    _prewarm()
+    with messaging.connect(args.broker) as connection:
+        worker = Worker(connection, processes=args.processes, prefetch=args.prefetch, max_jobs=args.max_jobs,
+                        threads=args.threads)
+
+        def shutdown(signum, frame):
+            if worker.stopping:
+                # A second signal abandons the jobs in progress, which the broker redelivers
+                raise SystemExit(1)
+            logger.info("Finishing the jobs in progress before stopping; signal again to stop now")
+            worker.stop()
+
+        signal.signal(signal.SIGTERM, shutdown)
+        signal.signal(signal.SIGINT, shutdown)
+        worker.run()
+
+if __name__ == "__main__":
+    main()
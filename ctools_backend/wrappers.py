@@ -1,30 +1,48 @@
-import math
 import os
-import subprocess
+import copy
+import filecmp
+import functools
+import shutil
 import itertools
-import time
+import logging
+import threading
+from collections import OrderedDict, namedtuple
 import numpy
 
 from mako.lookup import TemplateLookup
-import tablib
 
-from ctools_backend import geo
+from ctools_backend import metrics, refinement, result_cache, sharding, superposition, supervision, tables
 import settings
 import models
 
+logger = logging.getLogger(__name__)
+
 _lookup = TemplateLookup([settings.template_directory], strict_undefined=True)
 
 
-def create_source_csv(type_, instances, ignored_fields, file_name):
-    try:
-        instances_namedtuple = [i.as_namedtuple() for i in instances]
-    except AttributeError:
-        instances_namedtuple = instances
-    dataset = tablib.Dataset(headers=type_.fields, *instances_namedtuple)
-    for field in ignored_fields:
-        del dataset[field]
-    with open(file_name, 'w') as f:
-        f.write(dataset.csv)
+_process_slots = None
+_process_slots_lock = threading.Lock()
+
+
+def _new_supervisor():
+    """
+    Returns a supervisor for a run's model runs.  Every run in the process shares one limit of
+    sharding.default_worker_count() binaries at a time, however many threads they are run on.
+    """
+    global _process_slots
+    with _process_slots_lock:
+        if _process_slots is None:
+            _process_slots = supervision.ProcessSlots(sharding.default_worker_count())
+    return supervision.ProcessSupervisor(slots=_process_slots)
+
+
+_SourceRun = namedtuple("SourceRun", ["name", "source_file", "generate", "output_file", "sources",
+                                      "ignored_fields", "receptors"])
+
+
+def create_source_csv(table, ignored_fields, file_name):
+    fields = [f for f in table.fields if f not in ignored_fields]
+    tables.write_csv(file_name, fields, [table[f] for f in fields])
 
 
 class CTools(object):
@@ -32,30 +50,39 @@ class CTools(object):
     _program = os.path.join(settings.ctools_dir, "CTOOLS_HOURLY.ifort.x")
     _annual_program = os.path.join(settings.ctools_dir, "CTOOLS_ANNUAL.ifort.x")
 
-    def __init__(self, scenario, scenario_run, output_directory=None):
+    def __init__(self, scenario, scenario_run, output_directory=None, receptor_shards=None, source_chunks=None,
+                 receptor_mode=None):
         self.scenario = scenario
         self.scenario_run = scenario_run
+        self.receptor_shards = receptor_shards
+        self.source_chunks = source_chunks
+        self.receptor_mode = receptor_mode or settings.receptor_mode
         if scenario.include_area_sources:
-            for a in scenario.area_sources:
-                a[0] = a[0].replace(" ", "_").replace(",", "")
-            self.area_sources = [models.AreaSource.construct_namedtuple(*a) for a in scenario.area_sources]
+            self.area_sources = tables.SourceTable.from_rows(models.AreaSource, scenario.area_sources)
         if scenario.include_point_sources:
-            for p in scenario.point_sources:
-                p[0] = p[0].replace(" ", "_").replace(",", "")
-            self.point_sources = [models.PointSource.construct_namedtuple(*p) for p in scenario.point_sources]
+            self.point_sources = tables.SourceTable.from_rows(models.PointSource, scenario.point_sources)
         if scenario.include_railways:
-            self.railways = [models.Railway.construct_namedtuple(*r) for r in scenario.railways]
+            self.railways = tables.SourceTable.from_rows(models.Railway, scenario.railways)
         if scenario.include_roads:
-            self.roads = self._split_roads(models.Road.construct_namedtuple(*r) for r in scenario.roads)
+            self.roads = self._split_roads(tables.SourceTable.from_rows(models.Road, scenario.roads))
         if scenario.include_ships_in_transit:
-            for sit in scenario.ships_in_transit:
-                sit[0] = sit[0].replace(" ", "_").replace(",", "")
-            self.ships_in_transit = [models.ShipInTransit.construct_namedtuple(*r) for r in scenario.ships_in_transit]
-        if output_directory:
-            self.output_directory = output_directory
-        else:
-            self.output_directory = scenario_run.output_directory
+            self.ships_in_transit = tables.SourceTable.from_rows(models.ShipInTransit, scenario.ships_in_transit)
+        self.options = {}
+        self._receptors = None
+        self._model_receptors = None
+        self._merged_into = None
+        self._supervisor = None
+        self._jobs = None
+        self._superposition = None
+        self._shared_files_of = None
+        self._shard_files = {}
+        self._shared_outputs = {}
+        self._set_output_directory(output_directory or scenario_run.output_directory)
+
+    def _set_output_directory(self, output_directory):
+        self.output_directory = output_directory
         self.inputs_file = os.path.join(self.output_directory, "CTOOLS_Inputs.txt")
+        self.shard_directory = os.path.join(self.output_directory, "shards")
         self.receptor_file = os.path.join(self.output_directory, "receptors.csv")
         self.area_source_file = os.path.join(self.output_directory, "area.csv")
         self.point_source_file = os.path.join(self.output_directory, "points.csv")
@@ -74,197 +101,556 @@ class CTools(object):
 
     @staticmethod
     def _split_roads(roads):
-        split_roads = []
-        for road in roads:
-            road_dict = road._asdict()
-            if not len(road.geom) > 2:
-                (from_lng, from_lat) = road.geom[0]
-                (to_lng, to_lat) = road.geom[1]
-                (from_x, from_y) = geo.mercator_to_lcc(from_lng, from_lat)
-                (to_x, to_y) = geo.mercator_to_lcc(to_lng, to_lat)
-                road_dict["from_x"] = from_x
-                road_dict["from_y"] = from_y
-                road_dict["to_x"] = to_x
-                road_dict["to_y"] = to_y
-                split_roads.append(models.Road.namedtuple_class(**road_dict))
-                continue
-            # The road is curved and we need to reduce it to straight line segments
-            for segment in zip(road.geom[:-1], road.geom[1:]):
-                (from_lat, from_lng) = segment[0]
-                (to_lat, to_lng) = segment[1]
-                (from_x, from_y) = geo.mercator_to_lcc(from_lng, from_lat)
-                (to_x, to_y) = geo.mercator_to_lcc(to_lng, to_lat)
-                road_dict["from_x"] = from_x
-                road_dict["from_y"] = from_y
-                road_dict["to_x"] = to_x
-                road_dict["to_y"] = to_y
-                road_dict["geom"] = segment
-                split_roads.append(models.Road.namedtuple_class(**road_dict))
+        # Curved roads are reduced to straight line segments, one per pair of consecutive vertices
+        split_roads = roads.segments()
+        (xs, ys) = split_roads.projected_coordinates
+        split_roads.columns["from_x"] = xs[0::2]
+        split_roads.columns["from_y"] = ys[0::2]
+        split_roads.columns["to_x"] = xs[1::2]
+        split_roads.columns["to_y"] = ys[1::2]
         return split_roads
 
+    def ensemble_member(self, output_directory, **options):
+        """
+        Returns a run of the same scenario over the same receptors, with some of the options written to
+        CTOOLS_Inputs.txt (see _input_options) changed.  The member links to this run's receptor and
+        source files instead of writing its own, so they must be generated before the member is run.
+        """
+        member = copy.copy(self)
+        member._receptors = self.receptors
+        (member._model_receptors, member._merged_into) = (self.model_receptors, self._merged_into)
+        member.options = dict(self.options, **options)
+        member._supervisor = None
+        member._jobs = None
+        member._shared_files_of = self
+        member._shard_files = {}
+        member._set_output_directory(output_directory)
+        return member
+
+    def _input_options(self):
+        options = {"pollutant": self.scenario_run.pollutant, "met_conditions": self.scenario.met_conditions,
+                   "season": self.scenario.season, "day": self.scenario.day, "hour": self.scenario.hour}
+        options.update(self.options)
+        return options
+
     def _generate_input_file(self):
-        template = _lookup.get_template("CTOOLS_Inputs.txt")
-        inputs = template.render(scenario=self.scenario, scenario_run=self.scenario_run)
-        with open(self.inputs_file, 'w') as f:
-            f.write(inputs)
-
-    def _run(self):
-        starting_dir = os.getcwd()
-        os.chdir(settings.ctools_dir)
-        if self.scenario_run.model_type > 1:
-            program = self._annual_program
-        else:
-            program = self._program
-        processes = []
-        self._generate_receptor_file()
+        with metrics.phase("inputs"):
+            template = _lookup.get_template("CTOOLS_Inputs.txt")
+            inputs = template.render(**self._input_options())
+            with open(self.inputs_file, 'w') as f:
+                f.write(inputs)
+
+    def _generate_source_files(self):
+        """
+        Writes the receptor file and the source file of every included source type, or links them from
+        the run this one is an ensemble member of.  Returns the source runs.
+        """
+        with metrics.phase("inputs"):
+            source_runs = self._source_runs()
+            files = [self.receptor_file] + [source_run.source_file for source_run in source_runs]
+            if self._shared_files_of is not None:
+                for file_name in files:
+                    sharding.link(os.path.join(self._shared_files_of.output_directory, os.path.basename(file_name)),
+                                  file_name)
+                return source_runs
+            self._generate_receptor_file()
+            for source_run in source_runs:
+                source_run.generate()
+            return source_runs
+
+    def _source_runs(self):
+        """
+        Lists the source types included in the scenario.  Road and railway runs carry their source table
+        and the fields left out of their source file, so that they can be split into chunks.  A run's
+        receptors are None when it covers every receptor.
+        """
+        source_runs = []
         if self.scenario.include_area_sources:
-            self._generate_area_file()
-            processes.append(subprocess.Popen([program, "AREA", self.output_directory + "/"]))
+            source_runs.append(_SourceRun("AREA", self.area_source_file, self._generate_area_file,
+                                          self.area_file, None, None, None))
         if self.scenario.include_point_sources:
-            self._generate_point_file()
-            processes.append(subprocess.Popen([program, "POINT", self.output_directory + "/"]))
+            source_runs.append(_SourceRun("POINT", self.point_source_file, self._generate_point_file,
+                                          self.point_file, None, None, None))
         if self.scenario.include_railways:
-            self._generate_rail_file()
-            processes.append(subprocess.Popen([program, "RAIL", self.output_directory + "/"]))
+            source_runs.append(_SourceRun("RAIL", self.railway_source_file, self._generate_rail_file,
+                                          self.rail_file, self.railways, ["rrowner1", "geom"], None))
         if self.scenario.include_roads:
-            self._generate_road_file()
-            processes.append(subprocess.Popen([program, "ROAD", self.output_directory + "/"]))
+            source_runs.append(_SourceRun("ROAD", self.road_source_file, self._generate_road_file,
+                                          self.road_file, self.roads, ["gid", "sign1", "geom"], None))
         if self.scenario.include_ships_in_transit:
-            self._generate_sit_file()
-            processes.append(subprocess.Popen([program, "SIT", self.output_directory + "/"]))
-        while True:
-            time.sleep(1)
-            for p in processes:
-                p.poll()
-            if all(p.returncode is not None for p in processes):
-                break
-            status = self.scenario_run.current_status
+            source_runs.append(_SourceRun("SIT", self.sit_source_file, self._generate_sit_file,
+                                          self.sit_file, None, None, None))
+        return source_runs
+
+    def _generate_work_units(self, source_runs):
+        """
+        Splits the receptors into shards and the road and railway sources into chunks, and gives every
+        combination of source type, source chunk and receptor shard its own directory holding the run's
+        inputs.  Returns, for each source type, a list over source chunks of the directories of that
+        chunk's receptor shards.  Unsplit source types are run straight in the output directory.
+        """
+        if not os.path.isdir(self.shard_directory):
+            os.makedirs(self.shard_directory)
+        all_receptor_files = None
+        work_units = {}
+        for source_run in source_runs:
+            if source_run.receptors is not None:
+                receptor_files = self._generate_receptor_shards(source_run.receptors, "receptors-" + source_run.name)
+            else:
+                if all_receptor_files is None:
+                    all_receptor_files = self._generate_receptor_shards(self.model_receptors, "receptors")
+                receptor_files = all_receptor_files
+            source_files = [source_run.source_file]
+            if source_run.sources is not None:
+                source_count = len(source_run.sources)
+                chunk_count = sharding.source_chunk_count(source_count, self.source_chunks)
+                if chunk_count > 1:
+                    source_files = self._shared_shards(source_run.name, functools.partial(
+                        self._write_source_chunks, source_run, chunk_count))
+            if len(source_files) == 1 and receptor_files == [self.receptor_file]:
+                work_units[source_run.name] = [[self.output_directory]]
+                continue
+            work_units[source_run.name] = []
+            for (i, source_file) in enumerate(source_files):
+                directories = []
+                for (j, receptor_file) in enumerate(receptor_files):
+                    directory = os.path.join(self.shard_directory, "%s-%d-%d" % (source_run.name, i, j))
+                    os.makedirs(directory)
+                    sharding.link(self.inputs_file, os.path.join(directory, os.path.basename(self.inputs_file)))
+                    sharding.link(receptor_file, os.path.join(directory, os.path.basename(self.receptor_file)))
+                    sharding.link(source_file, os.path.join(directory, os.path.basename(source_run.source_file)))
+                    directories.append(directory)
+                work_units[source_run.name].append(directories)
+        return work_units
+
+    def _generate_receptor_shards(self, receptors, name):
+        """
+        Writes the receptors out as receptor shards, returning their files.  The run's own receptor file is
+        used when all of its receptors fit in one shard.
+        """
+        shard_count = sharding.receptor_shard_count(len(receptors), self.receptor_shards)
+        if shard_count == 1 and receptors is self.model_receptors:
+            return [self.receptor_file]
+        if receptors is self.model_receptors:
+            return self._shared_shards(name, functools.partial(self._write_receptor_shards, receptors, name,
+                                                               shard_count))
+        return self._write_receptor_shards(receptors, name, shard_count, self.shard_directory)
+
+    @staticmethod
+    def _write_receptor_shards(receptors, name, shard_count, directory):
+        receptor_files = []
+        for (i, selection) in enumerate(sharding.split(len(receptors), shard_count)):
+            receptor_files.append(os.path.join(directory, "%s-%d.csv" % (name, i)))
+            create_source_csv(receptors.take(selection), ["lat", "lng"], receptor_files[-1])
+        return receptor_files
+
+    @staticmethod
+    def _write_source_chunks(source_run, chunk_count, directory):
+        source_files = []
+        for (i, rows) in enumerate(sharding.split(len(source_run.sources), chunk_count)):
+            source_files.append(os.path.join(directory, "%s-%d.csv" % (source_run.name, i)))
+            create_source_csv(source_run.sources.take(numpy.arange(rows.start, rows.stop)),
+                              source_run.ignored_fields, source_files[-1])
+        return source_files
+
+    def _shared_shards(self, name, write):
+        """
+        Returns the shard files write writes to the directory it is given, here the shard directory.
+        Ensemble members share theirs instead, which are written once, to the shard directory of the run
+        they are members of, and linked into each member's work units from there.
+        """
+        owner = self._shared_files_of
+        if owner is None:
+            return write(self.shard_directory)
+        if name not in owner._shard_files:
+            if not os.path.isdir(owner.shard_directory):
+                os.makedirs(owner.shard_directory)
+            owner._shard_files[name] = write(owner.shard_directory)
+        return owner._shard_files[name]
+
+    def _model_program(self):
+        return self._annual_program if self.scenario_run.model_type > 1 else self._program
+
+    def _cache_keys(self, cache, source_runs):
+        """
+        Returns the result cache key of each of the source runs.
+        """
+        return [cache.key(self._model_program(), self.inputs_file, source_run.source_file)
+                for source_run in source_runs]
+
+    def _use_cached_results(self, cache, source_runs, locks=None, keys=None):
+        """
+        Looks every source type up in the result cache, waiting on any identical run already in progress
+        so that it is not computed twice.  Types the cache fully covers have their output written
+        straight away; the rest are returned to be run, limited to the receptors the cache is missing,
+        along with the cache claims to settle once they have run.  locks holds the locks of the keys
+        when the caller has already taken them (see _run_together), and keys the keys when it has already
+        worked them out.
+        """
+        pending = []
+        claims = []
+        if keys is None:
+            keys = self._cache_keys(cache, source_runs)
+        if locks is None:
+            locks = cache.lock_all(keys)
+        try:
+            for (source_run, key) in zip(source_runs, keys):
+                receptors = self.model_receptors if source_run.receptors is None else source_run.receptors
+                claims.append((source_run, key, locks[key]))
+                cached = cache.lookup(key, receptors)
+                if cached is None:
+                    pending.append(source_run)
+                    continue
+                (headers, rows, missing) = cached
+                if missing.any():
+                    pending.append(source_run._replace(receptors=receptors.take(missing)))
+                else:
+                    result_cache.write_output(source_run.output_file, headers, receptors, rows)
+                    claims.pop()[2].release()
+        except Exception:
+            self._settle_cached_results(cache, claims, False)
+            for key in keys:
+                locks[key].release()
+            raise
+        return pending, claims
+
+    def _settle_cached_results(self, cache, claims, succeeded):
+        """
+        Adds the results of the runs made for the claimed source types to the cache, completes the
+        outputs of the types that were only partly cached, and releases the claims.
+        """
+        try:
+            for (source_run, key, lock) in claims:
+                if succeeded:
+                    receptors = self.model_receptors if source_run.receptors is None else source_run.receptors
+                    cache.store(key, receptors, source_run.output_file)
+                    (headers, rows, missing) = cache.lookup(key, receptors)
+                    result_cache.write_output(source_run.output_file, headers, receptors, rows)
+        finally:
+            for (source_run, key, lock) in claims:
+                lock.release()
+
+    def _collect_work_units(self, source_runs, work_units):
+        """
+        Stitches the receptor shards of each source chunk back together, and sums the chunks, leaving
+        each source type's combined output in its usual output file.
+        """
+        for source_run in source_runs:
+            chunks = work_units[source_run.name]
+            if chunks == [[self.output_directory]]:
+                continue
+            chunk_files = []
+            for (i, directories) in enumerate(chunks):
+                shard_files = [os.path.join(d, os.path.basename(source_run.output_file)) for d in directories]
+                if len(chunks) == 1:
+                    sharding.stitch_outputs(shard_files, source_run.output_file)
+                else:
+                    chunk_files.append(os.path.join(self.shard_directory, "%s-%d-output.csv" % (source_run.name, i)))
+                    sharding.stitch_outputs(shard_files, chunk_files[-1])
+            if chunk_files:
+                sharding.sum_outputs(chunk_files, source_run.output_file)
+
+    def _run(self, source_runs=None):
+        try:
+            self._submit(_new_supervisor(), source_runs)
+            return_codes = self._wait()
+        except Exception:
+            self._finish(None)
+            raise
+        return self._finish(return_codes)
+
+    def share_outputs(self, other):
+        """
+        Takes the output of every source type whose inputs are identical in the other run from that run,
+        rather than computing it again.  Both runs' input and source files must already be generated,
+        and the other run must be finished first.
+        """
+        other_source_runs = {source_run.name: source_run for source_run in other._source_runs()}
+        if not filecmp.cmp(self.inputs_file, other.inputs_file, shallow=False) or \
+                not filecmp.cmp(self.receptor_file, other.receptor_file, shallow=False):
+            return
+        for source_run in self._source_runs():
+            other_source_run = other_source_runs.get(source_run.name)
+            if other_source_run is not None and \
+                    filecmp.cmp(source_run.source_file, other_source_run.source_file, shallow=False):
+                self._shared_outputs[source_run.name] = (other_source_run.output_file, source_run.output_file)
+
+    def _unshared(self, source_runs):
+        """
+        Leaves out the source runs whose outputs are taken from another run (see share_outputs).
+        """
+        return [source_run for source_run in source_runs if source_run.name not in self._shared_outputs]
+
+    def _submit(self, supervisor, source_runs=None, locks=None, keys=None):
+        """
+        Writes this run's files, unless its source runs are given because they already have been, and
+        submits the model runs it needs to the supervisor, leaving them to be run by supervisor.wait() and
+        then wrapped up by _finish().  locks and keys are the result cache locks and keys of its source runs
+        when the caller has already taken them (see _use_cached_results).
+        """
+        program = self._model_program()
+        self._supervisor = supervisor
+        self._cache = result_cache.ResultCache() if settings.result_cache_directory else None
+        self._claims = []
+        self._jobs = []
+        if source_runs is None:
+            source_runs = self._generate_source_files()
+        source_runs = self._unshared(source_runs)
+        if self._cache is not None:
+            (source_runs, self._claims) = self._use_cached_results(self._cache, source_runs, locks, keys)
+        self._superposition = None
+        if settings.road_superposition and self._cache is not None:
+            road_runs = [r for r in source_runs if r.name == "ROAD" and r.receptors is None]
+            if road_runs:
+                source_runs = [r for r in source_runs if r is not road_runs[0]]
+                self._superposition = superposition.RoadSuperposition(
+                    self._cache, program, self.inputs_file, self.receptor_file, self.model_receptors, self.roads,
+                    road_runs[0].ignored_fields, self.road_file, os.path.join(self.shard_directory, "superposition"))
+        self._pending_runs = source_runs
+        with metrics.phase("inputs"):
+            self._work_units = self._generate_work_units(source_runs)
+        if self._superposition is not None:
+            for directory in self._superposition.prepare():
+                self._jobs.append(supervisor.submit([program, "ROAD", directory + "/"], name="ROAD",
+                                                    cwd=settings.ctools_dir))
+        # Start the source types with the most sources first, as they are likely to take the longest
+        for source_run in sorted(source_runs, key=lambda r: -os.path.getsize(r.source_file)):
+            for directories in self._work_units[source_run.name]:
+                for directory in directories:
+                    self._jobs.append(supervisor.submit([program, source_run.name, directory + "/"],
+                                                        name=source_run.name, cwd=settings.ctools_dir))
+
+    def _wait(self):
+        """
+        Runs the submitted model runs, cancelling them if the scenario run is terminated meanwhile.
+        Returns the supervisor's return codes.
+        """
+        # The status callback runs on the listener thread, so it must not touch the ORM instance
+        run_type = type(self.scenario_run)
+        scenario_run_id = self.scenario_run.scenario_run_id
+
+        def status_changed(status):
+            if status is None:
+                status = run_type.get_status(scenario_run_id)
             if status == "terminated":
-                for p in processes:
-                    p.terminate()
-        os.chdir(starting_dir)
-        return [p.returncode for p in processes]
+                self.cancel()
+
+        def poll():
+            # Terminations are only pushed by databases with the notification triggers installed, so the status
+            # is looked up now and then as well
+            try:
+                status_changed(None)
+            except Exception:
+                logger.exception("Could not look up the status of scenario run %s", scenario_run_id)
+
+        subscription = supervision.watch_status(run_type.__tablename__, scenario_run_id, status_changed)
+        try:
+            # Terminations are pushed from here on; this covers one requested before the subscription
+            status_changed(None)
+            with metrics.phase("model"):
+                return self._supervisor.wait(poll)
+        finally:
+            supervision.unwatch_status(subscription)
+
+    def _finish(self, return_codes):
+        """
+        Collects the outputs of the submitted model runs and settles their cache claims.  Passing None for
+        the return codes abandons a run that never completed.  Returns this run's return codes.
+        """
+        if self._jobs is None:
+            return []
+        if return_codes is not None:
+            return_codes = [return_codes[i] for i in self._jobs if i < len(return_codes)]
+        succeeded = return_codes is not None and not self._supervisor.cancelled
+        with metrics.phase("outputs"):
+            try:
+                if succeeded:
+                    self._collect_work_units(self._pending_runs, self._work_units)
+                    if self._superposition is not None and not any(return_codes):
+                        self._superposition.finish()
+                    for (other_output_file, output_file) in self._shared_outputs.values():
+                        sharding.link(other_output_file, output_file)
+            finally:
+                self._jobs = None
+                if os.path.isdir(self.shard_directory):
+                    shutil.rmtree(self.shard_directory)
+                if self._cache is not None:
+                    self._settle_cached_results(self._cache, self._claims, succeeded and not any(return_codes))
+            if succeeded and not any(return_codes) and self.model_receptors is not self.receptors:
+                for source_run in self._source_runs():
+                    # Shared outputs were already expanded by the run they were taken from
+                    if source_run.name not in self._shared_outputs:
+                        sharding.expand_output(source_run.output_file, self.model_receptors, self.receptors,
+                                               self._merged_into)
+        return return_codes
+
+    def cancel(self):
+        """
+        Terminates the model runs in progress.  Safe to call from any thread.
+        """
+        if self._supervisor is not None:
+            self._supervisor.cancel()
 
     def _generate_receptor_file(self):
-        create_source_csv(models.Receptor, self.receptors, ["lat", "lng"], self.receptor_file)
+        create_source_csv(self.model_receptors, ["lat", "lng"], self.receptor_file)
 
     def _generate_road_file(self):
-        create_source_csv(models.Road, self.roads, ["gid", "sign1", "geom"], self.road_source_file)
+        create_source_csv(self.roads, ["gid", "sign1", "geom"], self.road_source_file)
 
     def _generate_area_file(self):
-        results = []
-        for source in self.area_sources:
-            results.extend(models.AreaSource.to_vertices(source))
-        dataset = tablib.Dataset(headers=["object_id", "sf_id", "x", "y", "nox", "benz", "pm2_5",
-                                          "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro", "butal_3", "toluene",
-                                          "so2"],
-                                 *results)
-        with open(self.area_source_file, 'w') as f:
-            f.write(dataset.csv)
+        sources = self.area_sources
+        rows = sources.vertex_rows()
+        (xs, ys) = sources.projected_coordinates
+        attributes = ["nox", "benz", "pm2_5", "dies_pm25", "ec", "oc", "co", "form", "ald2", "acro", "butal_3",
+                      "toluene", "so2"]
+        tables.write_csv(self.area_source_file, ["object_id", "sf_id", "x", "y"] + attributes,
+                         [sources["gid"][rows], sources["sf_id"][rows], xs, ys] + [sources[a][rows] for a in attributes])
 
     def _generate_point_file(self):
-        create_source_csv(models.PointSource, self.point_sources, ["pltname", "geom"], self.point_source_file)
+        create_source_csv(self.point_sources, ["pltname", "geom"], self.point_source_file)
 
     def _generate_rail_file(self):
-        create_source_csv(models.Railway, self.railways, ["rrowner1", "geom"], self.railway_source_file)
+        create_source_csv(self.railways, ["rrowner1", "geom"], self.railway_source_file)
 
     def _generate_sit_file(self):
-        create_source_csv(models.ShipInTransit, self.ships_in_transit, ["facility", "geom"], self.sit_source_file)
-
-    @staticmethod
-    def _merge_concentration_dicts(*dicts):
-        result_dict = dict()
-        all_keys = set()
-        for d in dicts:
-            for k in d.keys():
-                all_keys.add(k)
-        for key in all_keys:
-            result_dict[key] = sum(d.get(key, 0) for d in dicts)
-        return result_dict
+        create_source_csv(self.ships_in_transit, ["facility", "geom"], self.sit_source_file)
 
     def _load_concentrations_file(self):
-        ds = tablib.Dataset()
-        result_dicts = []
+        """
+        Sums the chosen metric over every source type's output file into one value per receptor, in
+        receptor order.
+        """
         if self.scenario_run.model_type > 1:
             model_field = self.scenario_run.model_type + 1
         else:
             model_field = 3
+        output_files = []
         if self.scenario.include_area_sources:
-            with open(self.area_file) as area_output:
-                ds.csv = area_output.read()
-                area_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(area_concentrations)
+            output_files.append(self.area_file)
         if self.scenario.include_point_sources:
-            with open(self.point_file) as point_output:
-                ds.csv = point_output.read()
-                point_concentrations = {int(r[0]): float(r[model_field]) for
-                                        r in ds}
-                result_dicts.append(point_concentrations)
+            output_files.append(self.point_file)
         if self.scenario.include_railways:
-            with open(self.rail_file) as rail_output:
-                ds.csv = rail_output.read()
-                rail_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(rail_concentrations)
+            output_files.append(self.rail_file)
         if self.scenario.include_roads:
-            with open(self.road_file) as road_output:
-                ds.csv = road_output.read()
-                road_concentrations = {int(r[0]): float(r[model_field]) for
-                                       r in ds}
-                result_dicts.append(road_concentrations)
+            output_files.append(self.road_file)
         if self.scenario.include_ships_in_transit:
-            with open(self.sit_file) as sit_output:
-                ds.csv = sit_output.read()
-                sit_concentrations = {int(r[0]): float(r[model_field]) for
-                                      r in ds}
-                result_dicts.append(sit_concentrations)
-        concentrations = self._merge_concentration_dicts(*result_dicts)
+            output_files.append(self.sit_file)
+        receptors = self.receptors
+        concentrations = numpy.zeros(len(receptors))
+        with metrics.phase("outputs"):
+            for output_file in output_files:
+                (ids, values) = tables.read_csv_columns(output_file, [0, model_field])
+                positions = receptors.index_of(ids.astype(numpy.int64))
+                known = positions >= 0
+                concentrations += numpy.bincount(positions[known], weights=values[known], minlength=len(receptors))
         return concentrations
 
     def calculate_concentrations(self):
         self._generate_input_file()
-        self._run()
-        concentrations = self._load_concentrations_file()
+        if self.receptor_mode == "adaptive":
+            concentrations = self._refine_receptors()
+        else:
+            self._run()
+            concentrations = self._load_concentrations_file()
         return self._generate_concentration_array(concentrations)
 
+    def _refine_receptors(self):
+        """
+        Places the receptors adaptively (see refinement.QuadtreeRefinement), refining on the log scale the
+        rasters are drawn on.  Each round runs the model over just the receptors it placed, and the rounds'
+        outputs are stitched together at the end.  Returns the concentrations at every receptor.
+        """
+        run = self.scenario_run
+        quadtree = refinement.QuadtreeRefinement((run.min_lng, run.min_lat, run.max_lng, run.max_lat))
+        source_runs = None
+        rounds = 0
+        placed = numpy.arange(len(quadtree))
+        while len(placed):
+            (lat, lng) = quadtree.lat_lng
+            self._receptors = models.ReceptorSet.from_lat_lng(numpy.arange(1, len(quadtree) + 1), lat, lng)
+            (self._model_receptors, self._merged_into) = (self._receptors, numpy.arange(len(quadtree)))
+            if source_runs is None:
+                source_runs = self._generate_source_files()
+                self._run(source_runs)
+            else:
+                self._run([source_run._replace(receptors=self._receptors.take(placed)) for source_run in source_runs])
+            concentrations = self._load_concentrations_file()[placed]
+            quadtree.add_values(numpy.log10(numpy.maximum(concentrations, 10 ** -6)))
+            for source_run in source_runs:
+                os.rename(source_run.output_file, "%s.%d" % (source_run.output_file, rounds))
+            rounds += 1
+            with metrics.phase("receptors"):
+                placed = quadtree.refine()
+        with metrics.phase("outputs"):
+            for source_run in source_runs:
+                output_files = ["%s.%d" % (source_run.output_file, i) for i in range(rounds)]
+                sharding.stitch_outputs(output_files, source_run.output_file)
+                for output_file in output_files:
+                    os.remove(output_file)
+        # The receptor file is left listing every receptor placed
+        self._generate_receptor_file()
+        return self._load_concentrations_file()
+
     @property
     def receptors(self):
-        count = itertools.count(1)
+        if self._receptors is None:
+            with metrics.phase("receptors"):
+                self._receptors = self._build_receptors()
+        return self._receptors
+
+    @property
+    def model_receptors(self):
+        """
+        The receptors the model is run over: the receptors with those within settings.receptor_merge_tolerance
+        of each other merged.  Outputs are expanded back to every receptor once the model has run.
+        """
+        if self._model_receptors is None:
+            with metrics.phase("receptors"):
+                (self._model_receptors, self._merged_into) = \
+                    self.receptors.merge_nearby(settings.receptor_merge_tolerance)
+        return self._model_receptors
+
+    def _build_receptors(self):
         grid_size = 50
-        min_lat = self.scenario_run.min_lat
-        max_lat = self.scenario_run.max_lat
-        min_lng = self.scenario_run.min_lng
-        max_lng = self.scenario_run.max_lng
         lat_spread = self.scenario_run.max_lat - self.scenario_run.min_lat
         lon_spread = self.scenario_run.max_lng - self.scenario_run.min_lng
         lat_delta = lat_spread / grid_size
         lon_delta = lon_spread / grid_size
         lat_start = self.scenario_run.min_lat + 0.5 * lat_delta
         lon_start = self.scenario_run.min_lng + 0.5 * lon_delta
-        receptors = []
-        for i in range(grid_size):
-            for j in range(grid_size):
-                receptor = models.Receptor(
-                    count.next(),
-                    lat=(lat_start + i * lat_delta),
-                    lng=(lon_start + j * lon_delta)
-                )
-                receptors.append(receptor)
-        for road in self.roads:
-            for receptor in self._receptors_for_road(road, count):
-                in_lat_range = min_lat < receptor.lat < max_lat
-                in_lon_range = min_lng < receptor.lng < max_lng
-                if in_lat_range and in_lon_range:
-                    receptors.append(receptor)
-        return receptors
+        steps = numpy.arange(grid_size)
+        grid = models.ReceptorSet.from_lat_lng(
+            numpy.arange(1, grid_size ** 2 + 1),
+            lat=numpy.repeat(lat_start + steps * lat_delta, grid_size),
+            lng=numpy.tile(lon_start + steps * lon_delta, grid_size)
+        )
+        if not self.scenario.include_roads:
+            return grid
+        return models.ReceptorSet.concatenate(grid, self._road_receptors(grid_size ** 2 + 1))
+
+    def _road_receptors(self, first_id):
+        """
+        Lays out receptors along the scenario's roads, keeping those within the scenario run's bounds.
+        """
+        run = self.scenario_run
+        road_receptors = self._receptors_for_roads(self.roads, first_id)
+        in_lat_range = (run.min_lat < road_receptors.lat) & (road_receptors.lat < run.max_lat)
+        in_lon_range = (run.min_lng < road_receptors.lng) & (road_receptors.lng < run.max_lng)
+        return road_receptors.take(in_lat_range & in_lon_range)
 
     @staticmethod
-    def _receptors_for_road(road, count):
-        x_delta = road.to_x - road.from_x
-        y_delta = road.to_y - road.from_y
+    def _receptors_for_roads(roads, first_id):
+        """
+        Lays out five lines of receptors along each road segment: one on the road itself, and one on
+        either side of it at each of two offsets.  Receptor ids are handed out road by road, line by line,
+        starting at first_id.
+        """
+        from_x = roads["from_x"]
+        from_y = roads["from_y"]
+        x_delta = roads["to_x"] - from_x
+        y_delta = roads["to_y"] - from_y
         squared_dist = x_delta ** 2 + y_delta ** 2
-        road_distance = math.sqrt(squared_dist)
+        road_distance = numpy.sqrt(squared_dist)
         # if self.zoom <= 12:
         # receptor_spacing = 500
         # elif self.zoom <= 15:
@@ -272,53 +658,185 @@ class CTools(object):
         # else:
         #     receptor_spacing = 100
         receptor_spacing = 200
-        receptor_count = max(int(math.floor(road_distance / receptor_spacing)), 1)
+        receptor_count = numpy.maximum(numpy.floor(road_distance / receptor_spacing).astype(numpy.int64), 1)
         receptor_x_delta = x_delta / receptor_count
         receptor_y_delta = y_delta / receptor_count
-        # x and y offsets are switched here to get the slope of the perpendicular line
-        x_offset = y_delta * abs(y_delta) / squared_dist
-        y_offset = x_delta * abs(x_delta) / squared_dist
-        receptors = [
-            models.Receptor(count.next(),
-                            y=(road.from_y + i * receptor_y_delta - 0.5 * receptor_y_delta),
-                            x=(road.from_x + i * receptor_x_delta - 0.5 * receptor_x_delta))
-            for i in range(receptor_count)
-        ]
-        receptors += [
-            models.Receptor(count.next(),
-                            y=(road.from_y + i * receptor_y_delta - 0.5 * receptor_y_delta + 5 * y_offset),
-                            x=(road.from_x + i * receptor_x_delta - 0.5 * receptor_x_delta - 5 * x_offset))
-            for i in range(receptor_count)
-        ]
-        receptors += [
-            models.Receptor(count.next(),
-                            y=(road.from_y + i * receptor_y_delta - 0.5 * receptor_y_delta - 5 * y_offset),
-                            x=(road.from_x + i * receptor_x_delta - 0.5 * receptor_x_delta + 5 * x_offset))
-            for i in range(receptor_count)
-        ]
-        receptors += [
-            models.Receptor(count.next(),
-                            y=(road.from_y + i * receptor_y_delta - 0.5 * receptor_y_delta + 25 * y_offset),
-                            x=(road.from_x + i * receptor_x_delta - 0.5 * receptor_x_delta - 25 * x_offset))
-            for i in range(receptor_count)
-        ]
-        receptors += [
-            models.Receptor(count.next(),
-                            y=(road.from_y + i * receptor_y_delta - 0.5 * receptor_y_delta - 25 * y_offset),
-                            x=(road.from_x + i * receptor_x_delta - 0.5 * receptor_x_delta + 25 * x_offset))
-            for i in range(receptor_count)
-        ]
-        return receptors
+        zero_length = squared_dist == 0
+        with numpy.errstate(divide="ignore", invalid="ignore"):
+            # x and y offsets are switched here to get the slope of the perpendicular line; zero length roads
+            # have no perpendicular, so theirs are left at 0 to keep their receptors on the road finite
+            x_offset = numpy.where(zero_length, 0, y_delta * numpy.abs(y_delta) / squared_dist)
+            y_offset = numpy.where(zero_length, 0, x_delta * numpy.abs(x_delta) / squared_dist)
+        # Each road contributes receptor_count receptors to each of the lines below, in this order
+        line_offsets = numpy.array([0, 5, -5, 25, -25], dtype=numpy.float64)
+        block_sizes = len(line_offsets) * receptor_count
+        total = int(block_sizes.sum())
+        road_index = numpy.repeat(numpy.arange(len(from_x)), block_sizes)
+        block_starts = numpy.cumsum(block_sizes) - block_sizes
+        position = numpy.arange(total) - numpy.repeat(block_starts, block_sizes)
+        line = position // receptor_count[road_index]
+        step = position % receptor_count[road_index] - 0.5
+        offset = line_offsets[line]
+        x = from_x[road_index] + step * receptor_x_delta[road_index] - offset * x_offset[road_index]
+        y = from_y[road_index] + step * receptor_y_delta[road_index] + offset * y_offset[road_index]
+        # Zero length roads keep their receptor on the road, but their offset lines, which would only repeat it,
+        # are dropped
+        valid = numpy.isfinite(x) & numpy.isfinite(y) & ~(zero_length[road_index] & (offset != 0))
+        ids = numpy.arange(first_id, first_id + total)
+        return models.ReceptorSet(ids[valid], x[valid], y[valid])
 
     def _generate_concentration_array(self, concentrations):
         min_non_zero = 10 ** -6
-        receptor_dict = {}
-        for receptor in self.receptors:
-            receptor_dict[receptor.id] = [receptor.x, receptor.y, min_non_zero]
-        for receptor in concentrations:
-            try:
-                concentration = max(float(concentrations[receptor]), min_non_zero)
-                receptor_dict[int(receptor)][2] = concentration
-            except KeyError:
-                pass
-        return numpy.array(receptor_dict.values())
+        receptors = self.receptors
+        return numpy.column_stack((receptors.x, receptors.y, numpy.maximum(concentrations, min_non_zero)))
+
+
+def _run_together(runs, source_runs):
+    """
+    Runs the model runs of several CTools runs of the same scenario run under one supervisor, so that they
+    share the worker limit and run in parallel.  source_runs gives each run's already generated source
+    runs.  Every result cache key is locked, holding a file open, until its run finishes, so runs with more
+    than settings.result_cache_lock_limit keys between them are made in batches, one after another; once a
+    batch is cancelled the rest are not made.  Returns each run's return codes.
+    """
+    source_runs = [run._unshared(run_source_runs) for (run, run_source_runs) in zip(runs, source_runs)]
+    cache = result_cache.ResultCache() if settings.result_cache_directory else None
+    keys = [run._cache_keys(cache, run_source_runs) if cache is not None else []
+            for (run, run_source_runs) in zip(runs, source_runs)]
+    batches = []
+    for (i, run_keys) in enumerate(keys):
+        if not batches or len(batches[-1][1].union(run_keys)) > settings.result_cache_lock_limit:
+            batches.append(([], set()))
+        batches[-1][0].append(i)
+        batches[-1][1].update(run_keys)
+    return_codes = []
+    cancelled = False
+    for (indices, batch_keys) in batches:
+        if cancelled:
+            return_codes += [[] for _ in indices]
+            continue
+        batch = [runs[i] for i in indices]
+        return_codes += _run_batch(batch, [source_runs[i] for i in indices], [keys[i] for i in indices], cache,
+                                   batch_keys)
+        cancelled = batch[0]._supervisor.cancelled
+    return return_codes
+
+
+def _run_batch(runs, source_runs, keys, cache, batch_keys):
+    """
+    Makes one batch of _run_together's runs, given each run's result cache keys and all of them together.
+    """
+    locks = {}
+    if cache is not None:
+        # Every run's keys are locked together before any run claims them, so that groups of runs whose
+        # keys overlap (say, comparisons of A with B and of B with A) wait for one another rather than each
+        # holding keys the other needs
+        locks = cache.lock_all(batch_keys)
+    try:
+        supervisor = _new_supervisor()
+        submitted = []
+        try:
+            for (run, run_source_runs, run_keys) in zip(runs, source_runs, keys):
+                submitted.append(run)
+                run._submit(supervisor, run_source_runs, locks, run_keys)
+            return_codes = runs[0]._wait()
+        except Exception:
+            for run in submitted:
+                run._finish(None)
+            raise
+        return [run._finish(return_codes) for run in runs]
+    finally:
+        # Runs release their claims as they finish; this covers the keys of runs that never got that far
+        for lock in locks.values():
+            lock.release()
+
+
+class CToolsEnsemble(object):
+    """
+    Runs a scenario for every combination of a list of pollutants and lists of met conditions, seasons,
+    days and hours.  Only CTOOLS_Inputs.txt differs between the members, so the receptor and source
+    files, and any receptor shards and source chunks, are written once and linked into each member's
+    directory, and the members' model runs share supervisors (see _run_together) so that they run in
+    parallel.  Options left as None keep the scenario's value.
+    """
+
+    def __init__(self, scenario, scenario_run, pollutants, met_conditions=None, seasons=None, days=None,
+                 hours=None, output_directory=None):
+        self.base = CTools(scenario=scenario, scenario_run=scenario_run, output_directory=output_directory)
+        self.members = []
+        # Repeated option values would make repeated members, so only the first of each is kept
+        options = [OrderedDict.fromkeys(values).keys() for values in (
+            pollutants, met_conditions or [scenario.met_conditions], seasons or [scenario.season],
+            days or [scenario.day], hours or [scenario.hour])]
+        combinations = itertools.product(*options)
+        for (pollutant, met, season, day, hour) in combinations:
+            name = "pollutant_%s_met_%s_season_%s_day_%s_hour_%s" % (pollutant, met, season, day, hour)
+            directory = os.path.join(self.base.output_directory, "members", name)
+            self.members.append(self.base.ensemble_member(directory, pollutant=pollutant, met_conditions=met,
+                                                          season=season, day=day, hour=hour))
+
+    def calculate_concentrations(self):
+        """
+        Runs every member, returning their concentration arrays in member order.
+        """
+        for member in self.members:
+            os.makedirs(member.output_directory)
+            member._generate_input_file()
+        self.base._generate_source_files()
+        try:
+            _run_together(self.members, [member._generate_source_files() for member in self.members])
+        finally:
+            # Holds the receptor shards and source chunks the members shared
+            if os.path.isdir(self.base.shard_directory):
+                shutil.rmtree(self.base.shard_directory)
+        return [member._generate_concentration_array(member._load_concentrations_file()) for member in self.members]
+
+    def cancel(self):
+        """
+        Terminates the model runs in progress.  Safe to call from any thread.
+        """
+        for member in self.members:
+            member.cancel()
+
+
+class CToolsComparison(object):
+    """
+    Runs the two scenarios of a comparison side by side.  Both sides are run over the same receptors, the
+    shared grid plus the road receptors of both scenarios, so that their results line up receptor for
+    receptor.  Source types whose inputs are identical in both scenarios, usually everything but the
+    roads, are computed once for the first scenario and shared with the second.
+    """
+
+    def __init__(self, scenario_1, scenario_2, scenario_run):
+        self.runs = [CTools(scenario=scenario_1, scenario_run=scenario_run,
+                            output_directory=scenario_run.output_directory_1),
+                     CTools(scenario=scenario_2, scenario_run=scenario_run,
+                            output_directory=scenario_run.output_directory_2)]
+        receptors = self.runs[0].receptors
+        if self.runs[1].scenario.include_roads:
+            road_receptors = self.runs[1]._road_receptors(receptors.id[-1] + 1)
+            # Receptors on roads both scenarios have are already there
+            new = ~numpy.in1d(result_cache.coordinate_keys(road_receptors.x, road_receptors.y),
+                              result_cache.coordinate_keys(receptors.x, receptors.y))
+            receptors = models.ReceptorSet.concatenate(receptors, road_receptors.take(new))
+        for run in self.runs:
+            run._receptors = receptors
+
+    def calculate_concentrations(self):
+        """
+        Runs both scenarios, returning the concentration array of each.
+        """
+        source_runs = []
+        for run in self.runs:
+            run._generate_input_file()
+            source_runs.append(run._generate_source_files())
+        self.runs[1].share_outputs(self.runs[0])
+        _run_together(self.runs, source_runs)
+        return [run._generate_concentration_array(run._load_concentrations_file()) for run in self.runs]
+
+    def cancel(self):
+        """
+        Terminates the model runs in progress.  Safe to call from any thread.
+        """
+        for run in self.runs:
+            run.cancel()